@@ -200,7 +200,7 @@ class BooleanIn(In):
 
 class BooleanOut(Out):
     def post(self, formatter):
-        formatter.write(self.oz_out_prefix + ' = Boolean::build(vm, ' + self.cc_name + ');')
+        formatter.write(self.oz_out_prefix + ' = Boolean::build(vm, *' + self.cc_name + ');')
 
 #-------------------------------------------------------------------------------
 
@@ -214,4 +214,8 @@ class StringOut(Out):
     def post(self, formatter):
         formatter.write(self.oz_out_prefix + ' = buildString(vm, ' + self.cc_name + ');')
 
+class StaticStringOut(Out):
+    def post(self, formatter):
+        formatter.write(self.oz_out_prefix + ' = StaticStrings::get(vm, *' + self.cc_name + ');')
+
 
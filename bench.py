@@ -0,0 +1,162 @@
+import re
+from os import replace, remove
+from os.path import join
+from common import *
+
+_SAMPLE_INPUTS = {
+    'bool': 'true',
+    'int': '1',
+    'float': '1.0',
+    'string': '"m2g3"',
+    'flags': 'nil',
+}
+
+_module_var_rx = re.compile(r'\b([A-Z][A-Za-z0-9]*)\.([a-z][A-Za-z0-9]*)')
+
+def _oz_module_var(modname):
+    return modname[0].upper() + modname[1:]
+
+def _oz_module_url(var):
+    return 'x-oz://boot/' + var[0].lower() + var[1:] + '.ozf'
+
+
+class BenchmarkWriter:
+    """
+    Writer of the Oz benchmark functor of a library. It times N calls of every
+    builtin whose inputs can be made up from the argument metadata (see
+    `OzFunction.get_oz_arguments`): numbers, strings, enum atoms and flags,
+    and the handles named in ``BENCHMARK_HANDLES`` of the constants module.
+    The handles are created by ``BENCHMARK_SETUP`` before each builtin is
+    timed, and released by ``BENCHMARK_TEARDOWN`` afterwards. The functions
+    matching ``BENCHMARK_BLACKLISTED`` are never called.
+
+    The functor prints a tab-separated table, with one row per builtin grouped
+    by signature shape (the kinds of the inputs and outputs), preceded by the
+    row of an empty procedure measuring the overhead of the loop::
+
+        shape   module  builtin  calls  nanoseconds  nanoseconds/call
+    """
+
+    def __init__(self, basename, constants, lazy=False, calls=1000):
+        self._filename = join(SRC, basename + BENCH_OZ_EXT)
+        self._constants = constants
+        self._lazy = lazy
+        self._calls = calls
+        self._modnames = []
+        self._entries = []
+        self._handle_vars = sorted(set(constants.BENCHMARK_HANDLES.values()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, p, q, r):
+        if p is not None:
+            return False
+        temp_filename = self._filename + '.tmp'
+        try:
+            with open(temp_filename, 'w') as f:
+                self._write_functor(f)
+        except:
+            remove(temp_filename)
+            raise
+        replace(temp_filename, self._filename)
+        return False
+
+    def write_module(self, modname, ozfuncs):
+        """
+        Add the builtins of a module which can be benchmarked. The *ozfuncs*
+        are rendered functions (see `RenderedFunction`) or extra functions.
+        """
+        self._modnames.append(modname)
+        for ozfunc in ozfuncs:
+            arguments = ozfunc.get_oz_arguments()
+            if arguments is None:
+                continue
+            c_func_name = ozfunc.source_function_name
+            if any(regex.match(c_func_name) for regex in self._constants.BENCHMARK_BLACKLISTED):
+                continue
+            call_args = self._sample_arguments(arguments)
+            if call_args is None:
+                continue
+
+            inputs = [kind for inout, kind, _ in arguments if inout == 'In']
+            outputs = [kind for inout, kind, _ in arguments if inout == 'Out']
+            shape = '(' + ', '.join(inputs) + ') -> (' + ', '.join(outputs) + ')'
+            self._entries.append((shape, modname, ozfunc.oz_function_name, call_args))
+
+    def _sample_arguments(self, arguments):
+        call_args = []
+        for inout, kind, detail in arguments:
+            if inout == 'Out':
+                sample = '_'
+            elif kind == 'enum':
+                sample = None if detail is None else "'" + detail + "'"
+            elif kind == 'handle':
+                sample = self._constants.BENCHMARK_HANDLES.get(detail)
+            else:
+                sample = _SAMPLE_INPUTS.get(kind)
+            if sample is None:
+                return None
+            call_args.append(sample)
+        return call_args
+
+    def _lookup(self, code):
+        if not self._lazy:
+            return code
+        return _module_var_rx.sub(r'{\1.lookup \2}', code)
+
+    def _write_functor(self, f):
+        setup = self._constants.BENCHMARK_SETUP.strip().splitlines()
+        teardown = self._constants.BENCHMARK_TEARDOWN.strip().splitlines()
+        handles = ' '.join(self._handle_vars)
+
+        oz_modules = list(map(_oz_module_var, self._modnames))
+        for line in setup + teardown:
+            for var, _ in _module_var_rx.findall(line):
+                if var not in oz_modules:
+                    oz_modules.append(var)
+
+        f.write('functor\n\nimport\n')
+        f.write("    BootTime at 'x-oz://boot/Time'\n")
+        f.write('    System\n')
+        for oz_module in oz_modules:
+            f.write("    {0} at '{1}'\n".format(oz_module, _oz_module_url(oz_module)))
+
+        f.write('\ndefine\n')
+        f.write('    N = {0}\n\n'.format(self._calls))
+        f.write('    proc {Measure Shape Module Name P}\n')
+        for line in setup:
+            f.write('        ' + self._lookup(line.strip()) + '\n')
+        f.write('        Start Stop\n')
+        f.write('        proc {Loop I}\n')
+        f.write('            if I > 0 then\n')
+        f.write('                {P ' + handles + '}\n')
+        f.write('                {Loop I-1}\n')
+        f.write('            end\n')
+        f.write('        end\n')
+        f.write('    in\n')
+        f.write('        {P ' + handles + '}\n')
+        f.write('        Start = {BootTime.getMonotonicTime}\n')
+        f.write('        {Loop N}\n')
+        f.write('        Stop = {BootTime.getMonotonicTime}\n')
+        for line in teardown:
+            f.write('        ' + self._lookup(line.strip()) + '\n')
+        f.write('        {System.showInfo Shape#"\\t"#Module#"\\t"#Name#"\\t"#N#"\\t"#(Stop-Start)#"\\t"#((Stop-Start) div N)}\n')
+        f.write('    end\n\n')
+
+        f.write('    {System.showInfo "shape\\tmodule\\tbuiltin\\tcalls\\tnanoseconds\\tnanoseconds/call"}\n')
+        f.write("    {{Measure \"()\" '-' '(empty)' proc {{$ {0}}} skip end}}\n".format(handles))
+
+        for shape, modname, name, call_args in sorted(self._entries, key=lambda e: e[0]):
+            oz_module = _oz_module_var(modname)
+            if self._lazy:
+                builtin = 'F'
+                f.write('    local F = {{{0}.lookup \'{1}\'}} in\n    '.format(oz_module, name))
+            else:
+                builtin = oz_module + '.' + name
+            f.write("    {{Measure \"{0}\" '{1}' '{2}' proc {{$ {3}}} {{{4}}} end}}\n".format(
+                shape, modname, name, handles, ' '.join([builtin] + call_args)))
+            if self._lazy:
+                f.write('    end\n')
+
+        f.write('end\n')
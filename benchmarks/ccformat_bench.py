@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Benchmark CCFormatter on a large synthetic input, resembling a GTK-sized
+module, comparing the in-memory formatter with the streaming one. Checks that
+both produce the same bytes as the original formatter.
+
+    python3 benchmarks/ccformat_bench.py [number-of-functions]
+"""
+
+import sys
+import tracemalloc
+from tempfile import TemporaryFile
+from os.path import dirname, abspath
+from time import perf_counter
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from ccformat import CCFormatter
+
+class _OriginalFormatter:
+    # The formatter before streaming was added, as the reference output.
+
+    def __init__(self):
+        self._lines = []
+        self._indent = ""
+
+    def write(self, lines):
+        strip_lines = lines.strip()
+        if strip_lines:
+            for line in strip_lines.split('\n'):
+                self._add(line.strip())
+
+    def _add(self, line):
+        if not line:
+            self._lines.append('\n')
+            return
+        open_braces = sum(1 for c in line if c in '{[(')
+        close_braces = sum(1 for c in line if c in ')]}')
+        indent_string = self._indent
+        if line[0] == '}':
+            indent_string = indent_string[4:]
+        if close_braces > open_braces:
+            self._indent = self._indent[4:]
+        self._lines.extend((indent_string, line, '\n'))
+        if open_braces > close_braces:
+            self._indent += "    "
+
+
+def synthetic_chunks(count):
+    yield """
+        namespace m2g3 {
+            using namespace ::mozart;
+    """
+    for i in range(count):
+        yield """
+            void M_gtk::P_widgetFunction{0}::operator()(VM vm, In _x_oz_in_widget, In _x_oz_in_x, Out _x_oz_out_return) {{
+        """.format(i)
+        yield """
+            GtkWidget* _x_cc_widget;
+            unbuild(vm, _x_oz_in_widget, _x_cc_widget);
+            int _x_cc_x;
+            unbuild(vm, _x_oz_in_x, _x_cc_x);
+            std::vector<GdkRectangle> _x_{0};
+            ozListForEach(vm, _x_oz_in_x, [vm, &_x_{0}](UnstableNode& node) {{
+                GdkRectangle content;
+                unbuild(vm, node, content);
+                _x_{0}.push_back(content);
+            }}, MOZART_STR("GdkRectangle"));
+
+            gboolean _x_{1} {{}};
+            auto _x_cc_return = &_x_{1};
+            *_x_cc_return = gtk_widget_function_{0}(_x_cc_widget, _x_cc_x, _x_{0}.data());
+            _x_oz_out_return = build(vm, *_x_cc_return);
+        """.format(i, i + 1)
+        yield "}"
+    yield "}"
+
+
+def run(formatter, chunks):
+    for chunk in chunks:
+        formatter.write(chunk)
+
+
+def measure(name, make_formatter, chunks, finish):
+    # timed and traced separately, since tracing slows down allocations.
+    start = perf_counter()
+    formatter = make_formatter()
+    run(formatter, chunks)
+    result = finish(formatter)
+    elapsed = perf_counter() - start
+    del formatter, result
+
+    tracemalloc.start()
+    formatter = make_formatter()
+    run(formatter, chunks)
+    result = finish(formatter)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{0}\t{1:.3f}s\tpeak {2:.1f} MiB'.format(name, elapsed, peak / 1048576))
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    chunks = list(synthetic_chunks(count))
+
+    reference = measure('original', _OriginalFormatter, chunks, lambda f: ''.join(f._lines))
+    in_memory = measure('in-memory', CCFormatter, chunks, str)
+
+    with TemporaryFile('w+') as stream:
+        def make_streaming():
+            stream.seek(0)
+            stream.truncate()
+            return CCFormatter(stream)
+        measure('streaming', make_streaming, chunks, lambda f: stream.flush())
+        stream.seek(0)
+        streamed = stream.read()
+
+    print('output: {0:.1f} MiB'.format(len(reference) / 1048576))
+    if in_memory != reference or streamed != reference:
+        print('MISMATCH: the formatted output differs from the original', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
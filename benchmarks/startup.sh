@@ -0,0 +1,32 @@
+#!/bin/sh
+# Measure the startup time and peak RSS of the test program, with the builtins
+# registered eagerly and lazily (LAZY_MODULES=yes). Each variant is rebuilt
+# from scratch and run $RUNS times; the mean wall time and peak RSS are printed.
+#
+#     benchmarks/startup.sh [make arguments...]
+
+RUNS=${RUNS:-10}
+MODULE=${MODULE:-cairo}
+TIME=${TIME:-/usr/bin/time}
+
+cd "$(dirname "$0")/.." || exit 1
+
+printf 'lazy\truns\tseconds\tmax-rss-kb\n'
+for lazy in no yes; do
+    make clean > /dev/null
+    if ! make LAZY_MODULES=$lazy "$@" test > /dev/null; then
+        echo "build failed with LAZY_MODULES=$lazy" >&2
+        exit 1
+    fi
+
+    i=0
+    while [ $i -lt "$RUNS" ]; do
+        "$TIME" -f '%e %M' -a -o src/startup-$lazy.txt "src/$MODULE-test" > /dev/null 2>&1
+        i=$((i + 1))
+    done
+
+    awk -v lazy=$lazy '
+        { seconds += $1; if ($2 > rss) rss = $2; n += 1 }
+        END { printf "%s\t%d\t%.4f\t%d\n", lazy, n, seconds / n, rss }
+    ' src/startup-$lazy.txt
+done
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Measure how the translator scales with the size of the C API. For each size, a
+synthetic library (C headers and a constants module in the shape of cairo.py)
+is written to a temporary directory, and translate() is run on it. The time
+and peak memory of each phase are printed, with the growth of the time since
+the previous size: a phase which scales linearly grows by the same factor as
+the size.
+
+    python3 benchmarks/translator_scaling.py [number-of-functions...]
+
+The handles, structs, enums, num_* array pairs and regex rules scale with the
+number of functions. The fixups, regex map lookups and formatting run inside
+the top-level phases; only their time is reported. The memory allocated by
+libclang is not traced, so the parse shows little memory. Before Python 3.9,
+the peak of a phase only counts the memory allocated during the phase.
+"""
+
+import sys
+import tracemalloc
+from collections import OrderedDict
+from os import chdir, getcwd, makedirs
+from os.path import dirname, abspath, join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+import translator
+import ozfunc
+import cache
+import builders
+import ccformat
+
+_TOP_LEVEL_PHASES = [
+    (translator, 'parse'),
+    (translator, 'collect_nodes'),
+    (translator, 'extract_nodes'),
+    (translator, 'write_types'),
+    (translator, 'write_modules'),
+]
+
+_NESTED_PHASES = [
+    (ozfunc, 'fixup_args', 'fixup_args'),
+    (builders, 'fixup_fields', 'fixup_fields'),
+    (ozfunc, 'find_from_regex_map', 'find_from_regex_map'),
+    (cache, 'find_from_regex_map', 'find_from_regex_map'),
+    (ccformat.CCFormatter, 'write', 'CCFormatter.write'),
+]
+
+_FUNCTIONS_PER_HEADER = 500
+
+#-------------------------------------------------------------------------------
+
+def synthetic_library(directory, basename, count):
+    """
+    Write the headers, C file and constants module of a synthetic library with
+    *count* functions. Every handle type gets a create and a destroy function,
+    and the other functions cycle through five shapes: plain arguments, an
+    enum result, a num_* array pair, two outputs named by a SPECIAL_ARGUMENTS
+    rule, and a pointer to a concrete struct.
+    """
+    include_dir = join(directory, 'include')
+    makedirs(include_dir)
+    makedirs(join(directory, 'c-files'))
+    makedirs(join(directory, 'src'))
+
+    handle_count = max(1, count // 10)
+    struct_count = max(1, count // 20)
+    enum_count = max(1, count // 20)
+    header_count = max(1, count // _FUNCTIONS_PER_HEADER)
+
+    common_decls = []
+    for s in range(struct_count):
+        common_decls.append("""
+typedef struct _synth_rect{0} {{
+    double x, y, width, height;
+    int num_points;
+    double *points;
+}} synth_rect{0}_t;
+""".format(s))
+    for e in range(enum_count):
+        enumerators = ',\n'.join('    SYNTH_MODE{0}_VALUE_{1}'.format(e, v) for v in range(8))
+        common_decls.append('typedef enum _synth_mode{0} {{\n{1}\n}} synth_mode{0}_t;\n'.format(e, enumerators))
+    for h in range(handle_count):
+        common_decls.append('typedef struct _synth_obj{0} synth_obj{0}_t;\n'.format(h))
+
+    with open(join(include_dir, 'synth-types.h'), 'w') as f:
+        f.write('#pragma once\n')
+        f.writelines(common_decls)
+
+    headers = [[] for _ in range(header_count)]
+    special_arguments = []
+    for h in range(handle_count):
+        decls = headers[h % header_count]
+        decls.append('synth_obj{0}_t *synth_obj{0}_create(void);\n'.format(h))
+        decls.append('void synth_obj{0}_destroy(synth_obj{0}_t *obj);\n'.format(h))
+
+    for i in range(count):
+        h = i % handle_count
+        obj = 'synth_obj{0}_t *obj'.format(h)
+        prefix = 'synth_obj{0}_'.format(h)
+        shape = i % 5
+        if shape == 0:
+            decl = 'void {0}op_{1}({2}, double x, int n);\n'.format(prefix, i, obj)
+        elif shape == 1:
+            decl = 'synth_mode{0}_t {1}get_mode_{2}({3});\n'.format(i % enum_count, prefix, i, obj)
+        elif shape == 2:
+            decl = 'void {0}set_values_{1}({2}, const double *values, int num_values);\n'.format(prefix, i, obj)
+        elif shape == 3:
+            decl = 'void {0}get_pair_{1}({2}, double *x, double *y);\n'.format(prefix, i, obj)
+            special_arguments.append("    '{0}get_pair_{1}$': {{'x': Out, 'y': Out}},\n".format(prefix, i))
+        else:
+            decl = 'void {0}set_rect_{1}({2}, const synth_rect{3}_t *rect);\n'.format(prefix, i, obj, i % struct_count)
+        headers[i % header_count].append(decl)
+
+    c_file = []
+    for j, decls in enumerate(headers):
+        header_name = 'synth-part{0}.h'.format(j)
+        with open(join(include_dir, header_name), 'w') as f:
+            f.write('#pragma once\n#include "synth-types.h"\n')
+            f.writelines(decls)
+        c_file.append('#include <{0}>\n'.format(header_name))
+
+    with open(join(directory, 'c-files', basename + '.c'), 'w') as f:
+        f.writelines(c_file)
+
+    concrete_structs = ', '.join("'_synth_rect{0}'".format(s) for s in range(struct_count))
+    flags = ', '.join("'_synth_mode{0}$'".format(e) for e in range(0, enum_count, 4))
+
+    with open(join(directory, basename + '.py'), 'w') as f:
+        f.write("""
+from common import *
+from arguments import *
+
+PKG_CONFIG_RES = ['-I{include}']
+
+BLACKLISTED = make_regex_set(['__va_list_tag$'])
+
+HEADER_WHITELIST = ['{include}/']
+
+SPECIAL_ARGUMENTS = make_regex_map({{
+{special_arguments}}})
+
+FUNCTION_PRE_SETUP = []
+FUNCTION_POST_SETUP = []
+FUNCTION_PRE_TEARDOWN = []
+FUNCTION_POST_TEARDOWN = []
+FUNCTION_CALL_REPLACEMENTS = []
+OFFLOADABLE = []
+PIN_FUNCTIONS = {{}}
+OFFLOAD_RELATED_HANDLES = {{}}
+
+BENCHMARK_HANDLES = {{}}
+BENCHMARK_SETUP = ''
+BENCHMARK_TEARDOWN = ''
+BENCHMARK_BLACKLISTED = []
+
+SPECIAL_ARGUMENTS_FOR_TYPES = {{}}
+SPECIAL_ARGUMENTS_FOR_RETURN_TYPES = {{}}
+STATIC_STRING_RETURNS = []
+SPECIAL_TYPES = {{}}
+SPECIAL_FUNCTIONS = {{}}
+EXTRA_DATATYPES = {{}}
+GC_COPIED_DATATYPES = {{}}
+SUPPORT_INCLUDES = []
+SUPPORT_CODE = []
+EXTRA_FUNCTIONS = {{}}
+
+FLAGS = make_regex_set([{flags}])
+CONCRETE_STRUCTS = {{{concrete_structs}}}
+CONCRETE_OPAQUE_STRUCTS = {{}}
+""".format(include=include_dir, special_arguments=''.join(special_arguments),
+           flags=flags, concrete_structs=concrete_structs))
+
+#-------------------------------------------------------------------------------
+
+def _reset_peak():
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        # Python < 3.9: clearing the traces also resets the peak.
+        tracemalloc.clear_traces()
+
+
+class PhaseRecorder:
+    """
+    Wraps the phase functions to accumulate their time and, if memory is
+    traced, the peak memory of the top-level phases.
+    """
+
+    def __init__(self, trace_memory):
+        self.seconds = OrderedDict()
+        self.peaks = {}
+        self._trace_memory = trace_memory
+        self._originals = []
+
+    def _wrap(self, owner, name, phase, top_level):
+        original = getattr(owner, name)
+        self._originals.append((owner, name, original))
+        self.seconds.setdefault(phase, 0.0)
+
+        def wrapper(*args, **kwargs):
+            if top_level and self._trace_memory:
+                _reset_peak()
+            start = perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.seconds[phase] += perf_counter() - start
+                if top_level and self._trace_memory:
+                    (_, peak) = tracemalloc.get_traced_memory()
+                    self.peaks[phase] = max(self.peaks.get(phase, 0), peak)
+
+        setattr(owner, name, wrapper)
+
+    def __enter__(self):
+        for owner, name in _TOP_LEVEL_PHASES:
+            self._wrap(owner, name, name, True)
+        for owner, name, phase in _NESTED_PHASES:
+            self._wrap(owner, name, phase, False)
+        if self._trace_memory:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, p, q, r):
+        if self._trace_memory:
+            tracemalloc.stop()
+        for owner, name, original in reversed(self._originals):
+            setattr(owner, name, original)
+        return False
+
+
+def measure(count, trace_memory):
+    basename = 'synth{0}{1}'.format(count, 'm' if trace_memory else '')
+    cwd = getcwd()
+    with TemporaryDirectory() as directory:
+        synthetic_library(directory, basename, count)
+        sys.path.insert(0, directory)
+        chdir(directory)
+        try:
+            with PhaseRecorder(trace_memory) as recorder:
+                start = perf_counter()
+                translator.translate([basename], fast_parse=True, use_cache=False)
+                recorder.seconds['total'] = perf_counter() - start
+        finally:
+            chdir(cwd)
+            sys.path.remove(directory)
+    return recorder
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [500, 1000, 2000, 4000]
+
+    print('functions\tphase\tseconds\tgrowth\tpeak-MiB')
+    previous = None
+    for count in sizes:
+        # timed and traced separately, since tracing slows down allocations.
+        timed = measure(count, False)
+        traced = measure(count, True)
+        for phase, seconds in timed.seconds.items():
+            growth = '-'
+            if previous is not None and previous.seconds.get(phase):
+                growth = '{0:.2f}'.format(seconds / previous.seconds[phase])
+            peak = traced.peaks.get(phase)
+            peak = '-' if peak is None else '{0:.1f}'.format(peak / 1048576)
+            print('{0}\t{1}\t{2:.3f}\t{3}\t{4}'.format(count, phase, seconds, growth, peak))
+        previous = timed
+
+
+if __name__ == '__main__':
+    main()
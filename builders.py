@@ -36,125 +36,391 @@ def _flag_sort_key(triple):
         return (1, -pop_count, value)
 
 
-class BuildersWriter(Writer):
-    def __init__(self, basename, constants):
-        super().__init__(join(SRC, basename + BUILDERS_HH_EXT))
-        self._basename = basename
-        self._constants = constants
-        self._flags = constants.FLAGS
+# The headers of the helpers, also precompiled (see `PrecompiledHeaderWriter`).
+BUILDERS_INCLUDES = ['<type_traits>', '<tuple>', '<unordered_map>', '<vector>', '<memory>', '<mutex>',
+                     '<string>', '<mozart.hh>']
+
+# The helpers shared by all builders. When several modules are generated
+# together, these are only written to the shared builders header.
+_RUNTIME_CODE = '''
+    template <typename T>
+    static inline constexpr bool is_integral_not_bool() {
+        return std::is_integral<T>::value && !std::is_same<typename std::decay<T>::type, bool>::value;
+    }
+
+    template <typename T>
+    using CharTypeOf = typename std::conditional<sizeof(T)==sizeof(char), char,
+                       typename std::conditional<sizeof(T)==sizeof(char16_t), char16_t,
+                       typename std::conditional<sizeof(T)==sizeof(char32_t), char32_t, void>::type>::type>::type;
+
+    class WrappedNode {
+        // Nodes attached as user data are stored in slabs of Oz
+        // arrays, so the GC sees one protected root per slab
+        // instead of one per node. A wrapped node is identified by
+        // the address of its slot, which never moves, and which
+        // points to the registry of its VM.
+        //
+        // The slabs are top-level arrays, only written on the top
+        // level: a node wrapped in a subspace is protected on its
+        // own, and the slot of a node released in a subspace is
+        // cleared on the next top-level create or destroy. The
+        // registry of a VM is freed when its last node is released.
+        enum : size_t { slabSize = 256 };
+
+        struct Registry {
+            VM vm;
+            std::vector<ProtectedNode> slabs;
+            std::vector<std::unique_ptr<WrappedNode[]>> slots;
+            std::vector<WrappedNode*> freeSlots;
+            std::vector<WrappedNode*> staleSlots;
+            size_t live = 0;
+            size_t peak = 0;
+        };
+
+        Registry* _registry;
+        size_t _index;
+        ProtectedNode _node;    // the node wrapped outside of the slabs.
+
+        WrappedNode() : _registry(nullptr), _index(0), _node() {}
+
+        static std::mutex& registriesMutex() {
+            static std::mutex mutex;
+            return mutex;
+        }
+
+        static std::unordered_map<VM, std::unique_ptr<Registry>>& registries() {
+            static std::unordered_map<VM, std::unique_ptr<Registry>> registries;
+            return registries;
+        }
+
+        static Registry& registryOf(VM vm) {
+            std::lock_guard<std::mutex> lock (registriesMutex());
+            auto& registry = registries()[vm];
+            if (!registry) {
+                registry.reset(new Registry);
+                registry->vm = vm;
+            }
+            return *registry;
+        }
 
-    def write_prolog(self):
-        super().write_prolog()
+        static void release(Registry& registry) {
+            for (auto& slab : registry.slabs) {
+                ozUnprotect(registry.vm, slab);
+            }
+            std::lock_guard<std::mutex> lock (registriesMutex());
+            registries().erase(registry.vm);
+        }
+
+        static void grow(Registry& registry) {
+            auto vm = registry.vm;
+            auto initial = ::mozart::build(vm, ::mozart::unit);
+            auto slab = Array::build(vm, slabSize, 0, initial);
+            size_t base = registry.slabs.size() * slabSize;
+            registry.slabs.push_back(ozProtect(vm, slab));
+
+            std::unique_ptr<WrappedNode[]> slots (new WrappedNode[slabSize]);
+            for (size_t i = slabSize; i-- > 0; ) {
+                slots[i]._registry = &registry;
+                slots[i]._index = base + i;
+                registry.freeSlots.push_back(&slots[i]);
+            }
+            registry.slots.push_back(std::move(slots));
+        }
+
+        // Only called on the top level, where the slabs may be written.
+        void put(RichNode node) {
+            auto vm = _registry->vm;
+            RichNode slab = *_registry->slabs[_index / slabSize];
+            auto index = SmallInt::build(vm, _index % slabSize);
+            ArrayLike(slab).arrayPut(vm, index, node);
+        }
+
+        static void clearStaleSlots(Registry& registry) {
+            for (auto slot : registry.staleSlots) {
+                auto initial = ::mozart::build(registry.vm, ::mozart::unit);
+                slot->put(initial);
+                registry.freeSlots.push_back(slot);
+            }
+            registry.staleSlots.clear();
+        }
+
+    public:
+        static void* create(VM vm, RichNode node) {
+            auto& registry = registryOf(vm);
+            WrappedNode* slot;
+            if (vm->isOnTopLevel()) {
+                clearStaleSlots(registry);
+                if (registry.freeSlots.empty()) {
+                    grow(registry);
+                }
+                slot = registry.freeSlots.back();
+                registry.freeSlots.pop_back();
+                slot->put(node);
+            } else {
+                slot = new WrappedNode;
+                slot->_registry = &registry;
+                slot->_node = ozProtect(vm, node);
+            }
 
-        self.write('''
-            #include <type_traits>
-            #include <unordered_map>
-            #include <mozart.hh>
-            #include "''' + self._basename + TYPES_DECL_HH_EXT + '''"
+            if (++ registry.live > registry.peak) {
+                registry.peak = registry.live;
+            }
+            return slot;
+        }
+
+        // Called by the C library (e.g. as a user data destroy callback),
+        // so it must not raise.
+        static void destroy(void* data) {
+            auto slot = static_cast<WrappedNode*>(data);
+            auto& registry = *slot->_registry;
+            if (slot->_node) {
+                ozUnprotect(registry.vm, slot->_node);
+                delete slot;
+            } else if (registry.vm->isOnTopLevel()) {
+                clearStaleSlots(registry);
+                auto initial = ::mozart::build(registry.vm, ::mozart::unit);
+                slot->put(initial);
+                registry.freeSlots.push_back(slot);
+            } else {
+                registry.staleSlots.push_back(slot);
+            }
 
-            namespace m2g3 {
-                using namespace mozart;
+            if (-- registry.live == 0) {
+                release(registry);
+            }
+        }
 
-                template <typename T>
-                static inline constexpr bool is_integral_not_bool() {
-                    return std::is_integral<T>::value && !std::is_same<typename std::decay<T>::type, bool>::value;
-                }
+        static UnstableNode get(VM vm, void* data) {
+            if (data == nullptr) {
+                return ::mozart::build(vm, ::mozart::unit);
+            }
 
-                template <typename T>
-                using CharTypeOf = typename std::conditional<sizeof(T)==sizeof(char), char,
-                                   typename std::conditional<sizeof(T)==sizeof(char16_t), char16_t,
-                                   typename std::conditional<sizeof(T)==sizeof(char32_t), char32_t, void>::type>::type>::type;
+            auto slot = static_cast<WrappedNode*>(data);
+            if (slot->_node) {
+                return UnstableNode(vm, *slot->_node);
+            }
+            RichNode slab = *slot->_registry->slabs[slot->_index / slabSize];
+            auto index = SmallInt::build(vm, slot->_index % slabSize);
+            return ArrayLike(slab).arrayGet(vm, index);
+        }
+
+        static UnstableNode stats(VM vm) {
+            size_t slabs = 0, live = 0, peak = 0;
+            {
+                std::lock_guard<std::mutex> lock (registriesMutex());
+                auto it = registries().find(vm);
+                if (it != registries().end()) {
+                    slabs = it->second->slabs.size();
+                    live = it->second->live;
+                    peak = it->second->peak;
+                }
+            }
+            return buildRecord(vm,
+                buildArity(vm, MOZART_STR("wrappedNodes"),
+                           MOZART_STR("capacity"), MOZART_STR("live"),
+                           MOZART_STR("peak"), MOZART_STR("slabs")),
+                slabs * slabSize, live, peak, slabs
+            );
+        }
+    };
+
+    template <typename T>
+    static auto unbuild(VM vm, RichNode oz, T& cc)
+        -> typename std::enable_if<is_integral_not_bool<T>()>::type
+    {
+        cc = static_cast<T>(IntegerValue(oz).intValue(vm));
+    }
+
+    template <typename T>
+    static auto unbuild(VM vm, RichNode oz, T& cc)
+        -> typename std::enable_if<std::is_floating_point<T>::value>::type
+    {
+        cc = static_cast<T>(FloatValue(oz).floatValue(vm));
+    }
+
+    template <typename It>
+    static UnstableNode buildDynamicList(VM vm, It begin, It end);
+
+    template <typename T>
+    static auto build(VM vm, T value)
+        -> typename std::enable_if<(is_integral_not_bool<T>() && std::is_signed<T>::value && sizeof(T) <= sizeof(nativeint)), UnstableNode>::type
+    {
+        nativeint extended = value;
+        return ::mozart::build(vm, extended);
+    }
+
+    template <typename T>
+    static auto build(VM vm, T value)
+        -> typename std::enable_if<(is_integral_not_bool<T>() && std::is_unsigned<T>::value && sizeof(T) <= sizeof(size_t)), UnstableNode>::type
+    {
+        size_t extended = value;
+        return ::mozart::build(vm, extended);
+    }
+
+    template <typename T>
+    static UnstableNode buildString(VM vm, const T* str) {
+        auto src = makeLString(static_cast<const CharTypeOf<T>*>(str));
+        auto utf = toUTF<nchar>(src);
+        auto lstring = newLString(vm, utf);
+        return String::build(vm, lstring);
+    }
+
+    template <typename T>
+    static void unbuildString(VM vm, RichNode oz, const T*& cc) {
+        std::basic_stringstream<nchar> buffer;
+        VirtualString(oz).toString(vm, buffer);
+        auto str = buffer.str();
+        auto utf = toUTF<CharTypeOf<T>>(makeLString(str.c_str(), str.length()));
+        auto lstring = newLString(vm, utf);
+        cc = static_cast<const T*>(lstring.string);
+    }
+
+    // The Oz strings of the C strings returned by the functions of
+    // STATIC_STRING_RETURNS, cached per VM by address. The content is
+    // compared on every hit, since the storage may be reused for
+    // another string, but it is not transcoded again. At most
+    // maxEntries addresses are cached per VM; strings at other
+    // addresses are built every time.
+    class StaticStrings {
+        struct Entry {
+            std::string content;
+            ProtectedNode node;
+        };
+
+        typedef std::unordered_map<const char*, Entry> Cache;
+
+        static Cache& cacheOf(VM vm) {
+            static std::mutex mutex;
+            static std::unordered_map<VM, std::unique_ptr<Cache>> caches;
+            std::lock_guard<std::mutex> lock (mutex);
+            auto& cache = caches[vm];
+            if (!cache) {
+                cache.reset(new Cache);
+            }
+            return *cache;
+        }
 
-                class WrappedNode {
-                    VM _vm;
-                    ProtectedNode _node;
+    public:
+        static const size_t maxEntries = 256;
 
-                    WrappedNode(VM vm, RichNode node) : _vm(vm), _node(ozProtect(vm, node)) {}
-                    ~WrappedNode() { ozUnprotect(_vm, _node); }
+        static UnstableNode get(VM vm, const char* str) {
+            if (str == nullptr) {
+                return buildString(vm, str);
+            }
 
-                public:
-                    static void* create(VM vm, RichNode node) {
-                        return new WrappedNode(vm, node);
-                    }
+            auto& cache = cacheOf(vm);
+            auto it = cache.find(str);
+            if (it == cache.end()) {
+                if (cache.size() >= maxEntries) {
+                    return buildString(vm, str);
+                }
+                it = cache.emplace(str, Entry {}).first;
+            }
 
-                    static void destroy(void* data) {
-                        delete static_cast<WrappedNode*>(data);
-                    }
+            auto& entry = it->second;
+            if (!entry.node || entry.content != str) {
+                auto node = buildString(vm, str);
+                entry.content = str;
+                entry.node = ozProtect(vm, node);
+            }
+            return UnstableNode(vm, *entry.node);
+        }
+    };
+'''
+
+# The non-template functions of the helpers, as (signature, body) pairs.
+_RUNTIME_FUNCTIONS = [
+    ('void unbuild(VM vm, RichNode oz, bool& cc)', 'cc = BooleanValue(oz).boolValue(vm);'),
+    ('UnstableNode build(VM vm, const char* cc)', 'return buildString(vm, cc);'),
+    ('UnstableNode build(VM vm, const char16_t* cc)', 'return buildString(vm, cc);'),
+    ('UnstableNode build(VM vm, const char32_t* cc)', 'return buildString(vm, cc);'),
+    ('void unbuild(VM vm, RichNode oz, const char*& cc)', 'unbuildString(vm, oz, cc);'),
+    ('void unbuild(VM vm, RichNode oz, const char16_t*& cc)', 'unbuildString(vm, oz, cc);'),
+    ('void unbuild(VM vm, RichNode oz, const char32_t*& cc)', 'unbuildString(vm, oz, cc);'),
+]
+
+
+class BuildersImplWriter(Writer):
+    """
+    The writer of the definitions of the builders, when they are split from
+    the builders header.
+    """
+
+    def __init__(self, basename):
+        super().__init__(join(SRC, basename + BUILDERS_CC_EXT))
+        self._basename = basename
 
-                    static UnstableNode get(VM vm, void* data) {
-                        if (data != nullptr) {
-                            auto node = static_cast<WrappedNode*>(data);
-                            return UnstableNode(node->_vm, *node->_node);
-                        } else {
-                            return ::mozart::build(vm, ::mozart::unit);
-                        }
-                    }
-                };
+    def write_prolog(self):
+        self.write("""
+            #include "{bn}{bd}"
+            #include "{bn}{ty}"
 
-                template <typename T>
-                static auto unbuild(VM vm, RichNode oz, T& cc)
-                    -> typename std::enable_if<is_integral_not_bool<T>()>::type
-                {
-                    cc = static_cast<T>(IntegerValue(oz).intValue(vm));
-                }
+            namespace m2g3 {{
+                using namespace mozart;
+        """.format(bn=self._basename, bd=BUILDERS_HH_EXT, ty=TYPES_HH_EXT))
 
-                template <typename T>
-                static auto unbuild(VM vm, RichNode oz, T& cc)
-                    -> typename std::enable_if<std::is_floating_point<T>::value>::type
-                {
-                    cc = static_cast<T>(FloatValue(oz).floatValue(vm));
-                }
+    def write_epilog(self):
+        self.write("}")
 
-                static void unbuild(VM vm, RichNode oz, bool& cc) {
-                    cc = BooleanValue(oz).boolValue(vm);
-                }
 
-                template <typename It>
-                static UnstableNode buildDynamicList(VM vm, It begin, It end);
+class BuildersWriter(Writer):
+    def __init__(self, basename, constants, shared_basename=None, with_epilog=True, split=False):
+        """
+        Create a builders writer. If *shared_basename* is given, the builders
+        header of that name is included instead of writing the common helpers.
+        The templates in the epilog can be omitted with *with_epilog*, for a
+        shared header which is always followed by a module's own builders.
+
+        If *split* is true, the header only declares the builders, and their
+        definitions are written to a separate ``-builders.cc`` file. Templates
+        are still defined in the header.
+        """
+        super().__init__(join(SRC, basename + BUILDERS_HH_EXT))
+        self._basename = basename
+        self._constants = constants
+        self._flags = constants.FLAGS
+        self._shared_basename = shared_basename
+        self._with_epilog = with_epilog
+        self._impl = BuildersImplWriter(basename) if split else None
 
-                template <typename T>
-                static auto build(VM vm, T value)
-                    -> typename std::enable_if<(is_integral_not_bool<T>() && std::is_signed<T>::value && sizeof(T) <= sizeof(nativeint)), UnstableNode>::type
-                {
-                    nativeint extended = value;
-                    return ::mozart::build(vm, extended);
-                }
+    def __enter__(self):
+        if self._impl is not None:
+            self._impl.__enter__()
+        return super().__enter__()
 
-                template <typename T>
-                static auto build(VM vm, T value)
-                    -> typename std::enable_if<(is_integral_not_bool<T>() && std::is_unsigned<T>::value && sizeof(T) <= sizeof(size_t)), UnstableNode>::type
-                {
-                    size_t extended = value;
-                    return ::mozart::build(vm, extended);
-                }
+    def __exit__(self, p, q, r):
+        try:
+            return super().__exit__(p, q, r)
+        finally:
+            if self._impl is not None:
+                self._impl.__exit__(p, q, r)
 
-                template <typename T>
-                static UnstableNode buildString(VM vm, const T* str) {
-                    auto src = makeLString(static_cast<const CharTypeOf<T>*>(str));
-                    auto utf = toUTF<nchar>(src);
-                    auto lstring = newLString(vm, utf);
-                    return String::build(vm, lstring);
-                }
+    def write_prolog(self):
+        super().write_prolog()
 
-                template <typename T>
-                static void unbuildString(VM vm, RichNode oz, const T*& cc) {
-                    std::basic_stringstream<nchar> buffer;
-                    VirtualString(oz).toString(vm, buffer);
-                    auto str = buffer.str();
-                    auto utf = toUTF<CharTypeOf<T>>(makeLString(str.c_str(), str.length()));
-                    auto lstring = newLString(vm, utf);
-                    cc = static_cast<const T*>(lstring.string);
-                }
+        if self._shared_basename is None:
+            for header in BUILDERS_INCLUDES:
+                self.write('#include ' + header)
+        else:
+            self.write('#include "' + self._shared_basename + BUILDERS_HH_EXT + '"')
 
-                static UnstableNode build(VM vm, const char* cc) { return buildString(vm, cc); }
-                static UnstableNode build(VM vm, const char16_t* cc) { return buildString(vm, cc); }
-                static UnstableNode build(VM vm, const char32_t* cc) { return buildString(vm, cc); }
-                static void unbuild(VM vm, RichNode oz, const char*& cc) { unbuildString(vm, oz, cc); }
-                static void unbuild(VM vm, RichNode oz, const char16_t*& cc) { unbuildString(vm, oz, cc); }
-                static void unbuild(VM vm, RichNode oz, const char32_t*& cc) { unbuildString(vm, oz, cc); }
+        self.write('#include "' + self._basename + TYPES_DECL_HH_EXT + '"')
+        self.write('''
+            namespace m2g3 {
+                using namespace mozart;
         ''')
 
+        if self._shared_basename is None:
+            self.write(_RUNTIME_CODE)
+            for signature, body in _RUNTIME_FUNCTIONS:
+                self._write_function(signature, body)
+
     def write_epilog(self):
+        if not self._with_epilog:
+            self.write('}')
+            super().write_epilog()
+            return
+
         self.write('''
                 template <typename T>
                 static auto build(VM vm, T* ptr)
@@ -171,10 +437,87 @@ class BuildersWriter(Writer):
                     }
                     return listBuilder.get(vm);
                 }
+
+                // The body of the builtins whose arguments are all unbuilt
+                // directly and whose result is built directly, as a template
+                // over the C function pointer. Used by the generic wrappers.
+                template <size_t... indices>
+                struct IndexSequence {};
+
+                template <size_t n, size_t... indices>
+                struct MakeIndexSequence : MakeIndexSequence<n-1, n-1, indices...> {};
+
+                template <size_t... indices>
+                struct MakeIndexSequence<0, indices...> {
+                    typedef IndexSequence<indices...> type;
+                };
+
+                template <typename F, F f>
+                struct GenericBuiltin;
+
+                template <typename R, typename... Args, R (*f)(Args...)>
+                struct GenericBuiltin<R (*)(Args...), f> {
+                    typedef std::tuple<typename std::decay<Args>::type...> Arguments;
+
+                    template <typename... Nodes>
+                    static UnstableNode call(VM vm, Nodes... nodes) {
+                        static_assert(sizeof...(Nodes) == sizeof...(Args), "wrong number of arguments");
+                        return build(vm, apply(vm, typename MakeIndexSequence<sizeof...(Args)>::type(), nodes...));
+                    }
+
+                    template <size_t... indices, typename... Nodes>
+                    static R apply(VM vm, IndexSequence<indices...>, Nodes... nodes) {
+                        Arguments args;
+                        int unbuilt[] = {0, (unbuild(vm, nodes, std::get<indices>(args)), 0)...};
+                        (void) unbuilt;
+                        return f(std::get<indices>(args)...);
+                    }
+                };
+
+                template <typename... Args, void (*f)(Args...)>
+                struct GenericBuiltin<void (*)(Args...), f> {
+                    typedef std::tuple<typename std::decay<Args>::type...> Arguments;
+
+                    template <typename... Nodes>
+                    static void call(VM vm, Nodes... nodes) {
+                        static_assert(sizeof...(Nodes) == sizeof...(Args), "wrong number of arguments");
+                        apply(vm, typename MakeIndexSequence<sizeof...(Args)>::type(), nodes...);
+                    }
+
+                    template <size_t... indices, typename... Nodes>
+                    static void apply(VM vm, IndexSequence<indices...>, Nodes... nodes) {
+                        Arguments args;
+                        int unbuilt[] = {0, (unbuild(vm, nodes, std::get<indices>(args)), 0)...};
+                        (void) unbuilt;
+                        f(std::get<indices>(args)...);
+                    }
+                };
             }
         ''')
         super().write_epilog()
 
+    def _write_function(self, signature, body):
+        """
+        Write a (non-template) builder function. It is defined static in the
+        header, or declared in the header and defined in the ``-builders.cc``
+        file if the builders are split. The *body* is a string, or a list of
+        strings which are written in order.
+        """
+        if isinstance(body, str):
+            body = [body]
+
+        if self._impl is None:
+            target = self
+            self.write('static ' + signature + ' {')
+        else:
+            target = self._impl
+            self.write(signature + ';')
+            target.write(signature + ' {')
+
+        for code in body:
+            target.write(code)
+        target.write('}')
+
     def write_type(self, type_node):
         """
         Write the builder and unbuilder representing the clang Node.
@@ -196,13 +539,11 @@ class BuildersWriter(Writer):
 
         else:
             if builder_string:
-                self.write('static UnstableNode build(VM vm, const ' + type_name + '& cc) {')
-                self.write(builder_string)
-                self.write('}')
+                self._write_function('UnstableNode build(VM vm, const ' + type_name + '& cc)',
+                                     builder_string)
             if unbuilder_string:
-                self.write('static void unbuild(VM vm, RichNode oz, ' + type_name + '& cc) {')
-                self.write(unbuilder_string)
-                self.write('}')
+                self._write_function('void unbuild(VM vm, RichNode oz, ' + type_name + '& cc)',
+                                     unbuilder_string)
 
     def _write_concrete_struct(self, struct_decl):
         struct_name = name_of(struct_decl)
@@ -213,51 +554,42 @@ class BuildersWriter(Writer):
 
         (_, atoms, builders, unbuilders) = zip(*field_objects.values())
 
-        self.write("""
-            static UnstableNode build(VM vm, const {s}& cc) {{
-                return buildRecord(vm,
-                    buildArity(vm, MOZART_STR("{ss}"), {f}),
-                    {b}
-                );
-            }}
-            static void unbuild(VM vm, RichNode oz, {s}& cc) {{
-                {x}
-            }}
-
+        self._write_function('UnstableNode build(VM vm, const {0}& cc)'.format(struct_name), """
+            return buildRecord(vm,
+                buildArity(vm, MOZART_STR("{ss}"), {f}),
+                {b}
+            );
         """.format(
-            s=struct_name,
             ss=strip_prefix_and_camelize(struct_name),
             f=', '.join(atoms),
-            b=', '.join(builders),
-            x=''.join(unbuilders)
+            b=', '.join(builders)
         ))
+        self._write_function('void unbuild(VM vm, RichNode oz, {0}& cc)'.format(struct_name),
+                             ''.join(unbuilders))
 
     def _write_concrete_opaque_struct(self, struct_decl):
-        self.write("""
-            static UnstableNode build(VM vm, const {0}& cc) {{
-                return D_{0}::build(vm, cc);
-            }}
-            static void unbuild(VM vm, RichNode node, {0}& cc) {{
-                cc = node.as<D_{0}>().value();
-            }}
-            static void unbuild(VM vm, RichNode node, const {0}*& cc) {{
-                cc = &(node.as<D_{0}>().value());
-            }}
-        """.format(name_of(struct_decl)))
+        struct_name = name_of(struct_decl)
+        self._write_function('UnstableNode build(VM vm, const {0}& cc)'.format(struct_name),
+                             'return D_{0}::build(vm, cc);'.format(struct_name))
+        self._write_function('void unbuild(VM vm, RichNode node, {0}& cc)'.format(struct_name),
+                             'cc = node.as<D_{0}>().value();'.format(struct_name))
+        self._write_function('void unbuild(VM vm, RichNode node, const {0}*& cc)'.format(struct_name),
+                             'cc = &(node.as<D_{0}>().value());'.format(struct_name))
 
     def _write_abstract_struct(self, struct_decl):
-        self.write("""
-            static UnstableNode build(VM vm, {0}* cc) {{
-                return D_{0}::build(vm, cc);
-            }}
-            static void unbuild(VM vm, RichNode node, {0}*& cc) {{
-                cc = node.as<D_{0}>().value();
-            }}
-            static void unbuild(VM vm, RichNode node, const {0}*& cc) {{
-                cc = node.as<D_{0}>().value();
-            }}
-
-        """.format(name_of(struct_decl)))
+        self.write_datatype(name_of(struct_decl))
+
+    def write_datatype(self, struct_name):
+        """
+        Write the builder and unbuilder of an abstract struct, i.e. one which
+        is wrapped as a datatype in Oz.
+        """
+        self._write_function('UnstableNode build(VM vm, {0}* cc)'.format(struct_name),
+                             'return D_{0}::build(vm, cc);'.format(struct_name))
+        self._write_function('void unbuild(VM vm, RichNode node, {0}*& cc)'.format(struct_name),
+                             'cc = node.as<D_{0}>().value();'.format(struct_name))
+        self._write_function('void unbuild(VM vm, RichNode node, const {0}*& cc)'.format(struct_name),
+                             'cc = node.as<D_{0}>().value();'.format(struct_name))
 
     def _write_enum(self, enum_decl):
         enum_name = name_of(enum_decl)
@@ -272,44 +604,41 @@ class BuildersWriter(Writer):
     def _write_real_enum(self, enum_name, cc_enum_names, enum_values, atom_names):
         # {{
 
-        self.write("""
-            static UnstableNode build(VM vm, """ + enum_name + """ cc) {
-                switch (cc) {
-                    default: return SmallInt::build(vm, cc);
-        """)
+        body = ["""
+            switch (cc) {
+                default: return SmallInt::build(vm, cc);
+        """]
 
         seen_values = set()
         for value, cc_enum_name, atom_name in zip(enum_values, cc_enum_names, atom_names):
             if value not in seen_values:
-                self.write("""
+                body.append("""
                     case {0}: return Atom::build(vm, MOZART_STR("{1}"));
                 """.format(cc_enum_name, atom_name))
                 seen_values.add(value)
 
-        self.write("""
-                }}
-            }}
+        body.append("}")
+        self._write_function('UnstableNode build(VM vm, ' + enum_name + ' cc)', body)
 
-            static void unbuild(VM vm, RichNode oz, {0}& cc) {{
-                static const std::unordered_map<std::basic_string<nchar>, {0}> map = {{
-        """.format(enum_name))
+        body = ["""
+            static const std::unordered_map<std::basic_string<nchar>, {0}> map = {{
+        """.format(enum_name)]
 
         for t in zip(atom_names, cc_enum_names):
-            self.write('{{MOZART_STR("{0}"), {1}}},'.format(*t))
+            body.append('{{MOZART_STR("{0}"), {1}}},'.format(*t))
 
-        self.write("""
-                };
+        body.append("""
+            };
 
-                auto str = vsToString<nchar>(vm, oz);
-                auto it = map.find(str);
-                if (it != map.end()) {
-                    cc = it->second;
-                } else {
-                    cc = static_cast<""" + enum_name +""">(IntegerValue(oz).intValue(vm));
-                }
+            auto str = vsToString<nchar>(vm, oz);
+            auto it = map.find(str);
+            if (it != map.end()) {
+                cc = it->second;
+            } else {
+                cc = static_cast<""" + enum_name +""">(IntegerValue(oz).intValue(vm));
             }
-
         """)
+        self._write_function('void unbuild(VM vm, RichNode oz, ' + enum_name + '& cc)', body)
 
         # }}
 
@@ -319,57 +648,49 @@ class BuildersWriter(Writer):
         triples = sorted(triples, key=_flag_sort_key)
         (cc_enum_names, enum_values, atom_names) = zip(*triples)
 
-        self.write("""
-            static UnstableNode build(VM vm, {0} cc) {{
-                OzListBuilder builder (vm);
-                auto flags = static_cast<size_t>(cc);
-        """.format(enum_name))
+        body = ["""
+            OzListBuilder builder (vm);
+            auto flags = static_cast<size_t>(cc);
+        """]
 
         for cc_enum_name, atom_name in zip(cc_enum_names, atom_names):
-            self.write("""
+            body.append("""
                 if ((flags & {0}) == {0}) {{
                     builder.push_front(vm, MOZART_STR("{1}"));
                     flags &= ~{0};
                 }}
             """.format(cc_enum_name, atom_name))
 
-        self.write("""
-                if (flags != 0) {{
-                    builder.push_front(vm, flags);
-                }}
-                return builder.get(vm);
-            }}
+        body.append("""
+            if (flags != 0) {
+                builder.push_front(vm, flags);
+            }
+            return builder.get(vm);
+        """)
+        self._write_function('UnstableNode build(VM vm, {0} cc)'.format(enum_name), body)
 
-            static void unbuild(VM vm, RichNode oz, {0}& cc) {{
-                static const std::unordered_map<std::basic_string<nchar>, std::underlying_type<{0}>::type> map = {{
-        """.format(enum_name))
+        body = ["""
+            static const std::unordered_map<std::basic_string<nchar>, std::underlying_type<{0}>::type> map = {{
+        """.format(enum_name)]
 
         for t in zip(atom_names, cc_enum_names):
-            self.write('{{MOZART_STR("{0}"), {1}}},'.format(*t))
-
-        self.write("""
-                }};
-
-                std::underlying_type<{0}>::type flags = 0;
-
-                ozListForEach(vm, oz, [vm, &flags](UnstableNode& node) {{
-                    auto str = vsToString<nchar>(vm, node);
-                    auto it = map.find(str);
-                    if (it != map.end()) {{
-                        flags |= it->second;
-                    }} else {{
-                        flags |= IntegerValue(node).intValue(vm);
-                    }}
-                }}, MOZART_STR("{0}"));
-
-                cc = static_cast<{0}>(flags);
-            }}
-        """.format(enum_name))
-
-
-
-
+            body.append('{{MOZART_STR("{0}"), {1}}},'.format(*t))
 
+        body.append("""
+            }};
 
+            std::underlying_type<{0}>::type flags = 0;
 
+            ozListForEach(vm, oz, [vm, &flags](UnstableNode& node) {{
+                auto str = vsToString<nchar>(vm, node);
+                auto it = map.find(str);
+                if (it != map.end()) {{
+                    flags |= it->second;
+                }} else {{
+                    flags |= IntegerValue(node).intValue(vm);
+                }}
+            }}, MOZART_STR("{0}"));
 
+            cc = static_cast<{0}>(flags);
+        """.format(enum_name))
+        self._write_function('void unbuild(VM vm, RichNode oz, {0}& cc)'.format(enum_name), body)
@@ -0,0 +1,212 @@
+import hashlib
+import pickle
+import sys
+from itertools import chain
+from inspect import getsource
+from os import replace
+from common import *
+from to_cc import to_cc
+
+_GENERATOR_MODULES = ['common', 'to_cc', 'fake_type', 'arguments', 'fixers', 'ozfunc', 'cache']
+
+_generator_hash = None
+def generator_hash():
+    """
+    Hash the source files of the modules which render the function bodies, so
+    that changing the generator invalidates the whole cache.
+    """
+    global _generator_hash
+    if _generator_hash is None:
+        h = hashlib.sha1()
+        for modname in _GENERATOR_MODULES:
+            __import__(modname)
+            with open(sys.modules[modname].__file__, 'rb') as f:
+                h.update(f.read())
+        _generator_hash = h.hexdigest()
+    return _generator_hash
+
+
+def _describe(value):
+    """
+    Describe a rule value stably across runs. Classes (e.g. the argument types
+    defined in the constants module) are described by their source code.
+    """
+    if isinstance(value, type):
+        try:
+            source = getsource(value)
+        except (OSError, TypeError):
+            source = ''
+        return value.__module__ + '.' + value.__qualname__ + ':' + source
+    elif isinstance(value, (tuple, list)):
+        return '(' + ', '.join(map(_describe, value)) + ')'
+    elif isinstance(value, (set, frozenset)):
+        return '{' + ', '.join(sorted(map(_describe, value))) + '}'
+    elif isinstance(value, dict):
+        return '{' + ', '.join(_describe(k) + ': ' + _describe(v)
+                               for k, v in sorted(value.items(), key=repr)) + '}'
+    else:
+        return repr(value)
+
+
+def signature_of(function):
+    """
+    Get the C signature of a function cursor, e.g. ``void cairo_move_to(cairo_t
+    * cr, double x, double y)``. The parameters of variadic functions end with
+    ``...``.
+    """
+    params = [to_cc(arg.type, name_of(arg))
+              for arg in function.get_children() if arg.kind == CursorKind.PARM_DECL]
+    if function.type.kind == TypeKind.FUNCTIONPROTO and function.type.is_function_variadic():
+        params.append('...')
+    return to_cc(function.result_type, name_of(function) + '(' + ', '.join(params) + ')')
+
+
+_REGEX_MAPS = ['SPECIAL_ARGUMENTS', 'FUNCTION_PRE_SETUP', 'FUNCTION_POST_SETUP',
+               'FUNCTION_PRE_TEARDOWN', 'FUNCTION_POST_TEARDOWN', 'FUNCTION_CALL_REPLACEMENTS']
+
+_TYPE_MAPS = ['SPECIAL_ARGUMENTS_FOR_TYPES', 'SPECIAL_ARGUMENTS_FOR_RETURN_TYPES', 'PIN_FUNCTIONS',
+              'OFFLOAD_RELATED_HANDLES']
+
+# ^ keyed by struct tag names (e.g. ``_cairo_matrix``), which do not occur in
+#   signatures spelled with typedefs, and which also apply through the fields
+#   of other structs, so they are covered as a whole.
+_STRUCT_MAPS = ['CONCRETE_STRUCTS', 'CONCRETE_OPAQUE_STRUCTS']
+
+def fingerprint(function, oz_function_name, mode, constants):
+    """
+    Compute the fingerprint of a function to be rendered. It covers the C
+    signature, the rules of the constants module which apply to the function,
+    the source of the generator, the Oz name and the mode (e.g. ``'sync'`` or
+    ``'async'``).
+
+    The type maps are keyed by type names. An entry is considered to apply if
+    its key occurs in the signature, which may include a few unrelated entries
+    but never misses one. The struct maps are covered entirely, so changing
+    them invalidates every function. The enumerators of the enums in the signature
+    and the ``FLAGS`` rules are covered too, since the argument metadata
+    depends on them.
+    """
+    c_func_name = name_of(function)
+    signature = signature_of(function)
+
+    parts = [generator_hash(), mode, oz_function_name, signature]
+    parts.append(_describe(constants.SPECIAL_FUNCTIONS.get(c_func_name)))
+    for map_name in _REGEX_MAPS:
+        parts.append(map_name + '=' + _describe(find_from_regex_map(getattr(constants, map_name), c_func_name)))
+    for map_name in _TYPE_MAPS:
+        type_map = getattr(constants, map_name)
+        if isinstance(type_map, dict):
+            matched = {k: v for k, v in type_map.items() if k in signature}
+        else:
+            matched = sorted(k for k in type_map if k in signature)
+        parts.append(map_name + '=' + _describe(matched))
+    for map_name in _STRUCT_MAPS:
+        parts.append(map_name + '=' + _describe(getattr(constants, map_name)))
+    parts.append('FLAGS=' + _describe(sorted(regex.pattern for regex in constants.FLAGS)))
+    parts.append('OFFLOADING=' + _describe(bool(constants.OFFLOADABLE)))
+    parts.append('STATIC_STRING_RETURNS=' + _describe(
+        any(regex.match(c_func_name) for regex in constants.STATIC_STRING_RETURNS)))
+
+    param_types = [arg.type for arg in function.get_children() if arg.kind == CursorKind.PARM_DECL]
+    for typ in chain(param_types, [function.result_type]):
+        canonical = typ.get_canonical()
+        if canonical.kind == TypeKind.ENUM:
+            parts.append(','.join(map(name_of, canonical.get_declaration().get_children())))
+
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+#-------------------------------------------------------------------------------
+
+class RenderedFunction:
+    """
+    The rendered code of a builtin, which can be written in place of the
+    function it was rendered from. Besides the Oz name, argument prototype and
+    body, it records the C function name and signature it came from, whether
+    the body records its calls to the trace, and the argument metadata (see
+    `OzFunction.get_oz_arguments`).
+    """
+
+    __slots__ = ('oz_function_name', 'arg_proto', 'body', 'source_function_name', 'signature', 'traced',
+                 'arguments')
+
+    def __init__(self, oz_function_name, arg_proto, body, source_function_name=None, signature=None,
+                 traced=False, arguments=None):
+        self.oz_function_name = oz_function_name
+        self.arg_proto = arg_proto
+        self.body = body
+        self.source_function_name = source_function_name
+        self.signature = signature
+        self.traced = traced
+        self.arguments = arguments
+
+    def get_arg_proto(self):
+        return self.arg_proto
+
+    def get_oz_arguments(self):
+        return self.arguments
+
+    def write_to(self, target):
+        for code in self.body:
+            target.write(code)
+
+
+class _Recorder:
+    def __init__(self):
+        self.body = []
+
+    def write(self, code):
+        self.body.append(code)
+
+
+def render(ozfunc, source_function_name=None, signature=None):
+    """
+    Render a function (an OzFunction, AsyncOzFunction or ExtraFunction).
+    """
+    arg_proto = ozfunc.get_arg_proto()
+    recorder = _Recorder()
+    ozfunc.write_to(recorder)
+    return RenderedFunction(ozfunc.oz_function_name, arg_proto, tuple(recorder.body),
+                            source_function_name, signature, getattr(ozfunc, 'traced', False),
+                            ozfunc.get_oz_arguments())
+
+
+class FunctionCache:
+    """
+    An on-disk cache of rendered functions, keyed by their fingerprints. Only
+    the entries used since the cache is loaded are saved back. If *load* is
+    false, the existing entries are ignored (and overwritten on save).
+    """
+
+    def __init__(self, filename, load=True):
+        self._filename = filename
+        self._entries = {}
+        if load:
+            try:
+                with open(filename, 'rb') as f:
+                    self._entries = pickle.load(f)
+            except Exception:
+                pass
+        self._used = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        rendered = self._entries.get(key)
+        if rendered is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._used[key] = rendered
+        return rendered
+
+    def put(self, key, rendered):
+        self._used[key] = rendered
+
+    def save(self):
+        temp_filename = self._filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            pickle.dump(self._used, f, pickle.HIGHEST_PROTOCOL)
+        replace(temp_filename, self._filename)
+
+
+__all__ = ['fingerprint', 'signature_of', 'render', 'RenderedFunction', 'FunctionCache']
@@ -2,9 +2,42 @@ import re
 from common import *
 from pkg_config import pkg_config
 from arguments import *
+from to_cc import to_cc
 
 PKG_CONFIG_RES = pkg_config(['cairo'])
 
+#-------------------------------------------------------------------------------
+
+class GlyphRunIn(ListIn):
+    """
+    Accepts either a glyph run returned by ``scaledFontTextToGlyphRun``, whose
+    native arrays are passed to cairo directly, or a list of glyph records.
+    """
+    def pre(self, formatter):
+        formatter.write("""
+            {d};
+            int {l};
+            std::vector<cairo_glyph_t> {u};
+            if (RichNode({oz}).is<D_m2g3_glyph_run>()) {{
+                auto run = RichNode({oz}).as<D_m2g3_glyph_run>().value();
+                {cc} = run->glyphs;
+                {l} = run->num_glyphs;
+            }} else {{
+                ozListForEach(vm, {oz}, [vm, &{u}](UnstableNode& node) {{
+                    cairo_glyph_t content;
+                    unbuild(vm, node, content);
+                    {u}.push_back(content);
+                }}, MOZART_STR("cairo_glyph_t"));
+                {cc} = {u}.data();
+                {l} = {u}.size();
+            }}
+        """.format(
+            d=to_cc(self._type, self.cc_name), u=unique_str(),
+            oz=self.oz_in_name, cc=self.cc_name, l=cc_name_of(self._context)
+        ))
+
+#-------------------------------------------------------------------------------
+
 BLACKLISTED = make_regex_set([
     '__va_list_tag$',
     'cairo_(?:rectangle_list|path)_destroy$',
@@ -19,7 +52,6 @@ BLACKLISTED = make_regex_set([
     'cairo_user_(?:scaled_font|font_face)',
     'cairo_surface_observer_add_',
     'cairo_(?:surface|device)_observer_print$',
-    'cairo_surface_write_to_png_stream$',
     'cairo_raster_source_pattern_[gs]et_(?:acquire|snapshot|copy|finish)$',
     'cairo_script_create_for_stream$',
     # ^ TODO: restore these functions (need callback support).
@@ -27,7 +59,7 @@ BLACKLISTED = make_regex_set([
     'cairo_pattern_create_raster_source$',
     'cairo_raster_source_pattern_[gs]et_callback_data$',
     # ^ TODO: restore these functions (need bytestring support).
-    'cairo_image_surface_create_(?:for_data|from_png_stream)$',
+    'cairo_image_surface_create_for_data$',
     # ^ TODO: needs to protect the data with this function!
     'g_unicode_canonical_ordering$',
     'cairo_append_path$'
@@ -59,9 +91,13 @@ SPECIAL_ARGUMENTS = make_regex_map({
         {'ctm': Out, 'scale_matrix': Out, 'font_matrix': Out},
     'cairo_(?:get_current|mesh_pattern_get_control)_point$':
         {'x': Out, 'y': Out},
-    'cairo_(?:show_(?:text_)?glyphs|glyph_path)$':
+    'cairo_show_text_glyphs$':
         {'utf8_len': (Constant, '-1')},
-    'cairo_(?:(?:scaled_font_)?(?:text|glyph)|(?:scaled_)?font|re(?:gion|cording_surface)_get)_extents$':
+    'cairo_(?:show_glyphs|glyph_path)$':
+        {'glyphs': (GlyphRunIn, 'num_glyphs'), 'num_glyphs': Skip},
+    'cairo_(?:scaled_font_)?glyph_extents$':
+        {'glyphs': (GlyphRunIn, 'num_glyphs'), 'num_glyphs': Skip, 'extents': Out},
+    'cairo_(?:(?:scaled_font_)?text|(?:scaled_)?font|re(?:gion|cording_surface)_get)_extents$':
         {'extents': Out},
     'cairo_scaled_font_text_to_glyphs$':
         {'cluster_flags': Out, 'utf8_len': (Constant, '-1')},
@@ -111,6 +147,70 @@ FUNCTION_POST_TEARDOWN = make_regex_map({
         'g_free(*' + CC_NAME_OF_RETURN + ');',
 })
 
+FUNCTION_CALL_REPLACEMENTS = make_regex_map({
+    'cairo_scaled_font_text_to_glyphs$':
+        'm2g3_cached_scaled_font_text_to_glyphs',
+    'cairo_text_extents$':
+        'm2g3_cached_text_extents',
+    'cairo_set_source_rgb$':
+        'm2g3_cached_set_source_rgb',
+    'cairo_set_source_rgba$':
+        'm2g3_cached_set_source_rgba',
+})
+
+OFFLOADABLE = make_regex_set([
+    'cairo_surface_write_to_png$',
+    'cairo_surface_(?:finish|flush)$',
+    'cairo_(?:fill|paint)(?:_preserve)?$',
+])
+# ^ these get an additional *Async builtin which runs the function on a worker
+#   thread. The Async calls sharing a handle of PIN_FUNCTIONS (or one of
+#   OFFLOAD_RELATED_HANDLES) run in order, one at a time, and the other builtins
+#   taking such a handle wait until no Async call uses it. Only the surfaces
+#   read through the source pattern are not covered: they must not be drawn to
+#   until the result variable is bound.
+
+PIN_FUNCTIONS = {
+    'cairo_t *': ('cairo_reference', 'cairo_destroy'),
+    'cairo_surface_t *': ('cairo_surface_reference', 'cairo_surface_destroy'),
+    'cairo_pattern_t *': ('cairo_pattern_reference', 'cairo_pattern_destroy'),
+}
+
+OFFLOAD_RELATED_HANDLES = {
+    'cairo_t *': ['cairo_get_target', 'cairo_get_group_target', 'cairo_get_source'],
+}
+# ^ the handles used through a handle of PIN_FUNCTIONS, which the offloaded
+#   calls and the builtins waiting for them also cover.
+
+BENCHMARK_HANDLES = {
+    'cairo_t *': 'Cr',
+    'cairo_surface_t *': 'Surface',
+}
+
+BENCHMARK_SETUP = """
+    Surface = {Cairo.imageSurfaceCreate argb32 64 64}
+    Cr = {Cairo.create Surface}
+"""
+
+BENCHMARK_TEARDOWN = """
+    {Cairo.destroy Cr}
+    {Cairo.surfaceDestroy Surface}
+"""
+
+BENCHMARK_BLACKLISTED = make_regex_set([
+    '.*_(?:destroy|finish|reference)$',
+    '.*_create',
+    '.*_write_to_png',
+    'cairo_(?:restore|pop_group)',
+    'cairo_(?:save|push_group(?:_with_content)?)$',
+    'cairo_debug_reset_static_data$',
+])
+# ^ the benchmark functor times the builtins whose inputs are numbers, strings,
+#   enums or the handles above, which are created again for each builtin.
+#   These functions would release the handles, leak a new object per call,
+#   write files, unbalance the state stack (growing it on every call), or reset
+#   the static data of cairo while surfaces are still alive.
+
 SPECIAL_ARGUMENTS_FOR_TYPES = {
     'cairo_destroy_func_t': (NodeDeleter, 0),
     'cairo_user_data_key_t const *': AddressIn,
@@ -121,6 +221,12 @@ SPECIAL_ARGUMENTS_FOR_RETURN_TYPES = {
     'gboolean': BooleanOut,
 }
 
+STATIC_STRING_RETURNS = make_regex_set([
+    'cairo_(?:status_to|version)_string$',
+])
+# ^ the C strings returned by these functions are static, so their Oz strings
+#   are cached by address (see `StaticStringOut`).
+
 SPECIAL_TYPES = {
     'cairo_path': ("""
         OzListBuilder nodes (vm);
@@ -203,6 +309,7 @@ SPECIAL_FUNCTIONS = {
         (', In cr, Out dashes, Out offset', """
             cairo_t* cc_cr;
             unbuild(vm, cr, cc_cr);
+            WorkerPool::waitIdle({cc_cr});
             int cc_num_dashes = cairo_get_dash_count(cc_cr);
             std::unique_ptr<double[]> cc_dashes (new double[cc_num_dashes]);
             double cc_offset;
@@ -214,12 +321,34 @@ SPECIAL_FUNCTIONS = {
         (', In surface, Out data', """
             cairo_surface_t* cc_surface;
             unbuild(vm, surface, cc_surface);
+            WorkerPool::waitIdle({cc_surface});
             int height = cairo_image_surface_get_height(cc_surface);
             int stride = cairo_image_surface_get_stride(cc_surface);
             int length = height * stride;
             auto cc_data = cairo_image_surface_get_data(cc_surface);
             data = ByteString::build(vm, newLString(vm, cc_data, length));
         """),
+    'cairo_surface_write_to_png_stream':
+        (', In surface, In sink, In chunkSize, Out status', """
+            cairo_surface_t* cc_surface;
+            unbuild(vm, surface, cc_surface);
+            WorkerPool::waitIdle({cc_surface});
+            size_t cc_chunk_size;
+            unbuild(vm, chunkSize, cc_chunk_size);
+            PngSink cc_sink (vm, sink, cc_chunk_size);
+            auto cc_status = cairo_surface_write_to_png_stream(cc_surface, &PngSink::write, &cc_sink);
+            cc_sink.rethrow();
+            if (cc_status == CAIRO_STATUS_SUCCESS) {
+                cc_status = cc_sink.flush();
+            }
+            status = build(vm, cc_status);
+        """),
+    'cairo_image_surface_create_from_png_stream':
+        (', In source, Out surface', """
+            PngSource cc_source (vm, source);
+            auto cc_surface = cairo_image_surface_create_from_png_stream(&PngSource::read, &cc_source);
+            surface = build(vm, cc_surface);
+        """),
     'g_unichar_fully_decompose':
         (', In ch, In compat, Out result', """
             gunichar cc_ch;
@@ -231,6 +360,1023 @@ SPECIAL_FUNCTIONS = {
         """),
 }
 
+EXTRA_DATATYPES = {
+    'm2g3_glyph_run': """
+        struct m2g3_glyph_run {
+            cairo_glyph_t* glyphs;
+            int num_glyphs;
+            cairo_text_cluster_t* clusters;
+            int num_clusters;
+            cairo_text_cluster_flags_t cluster_flags;
+        };
+
+        // A glyph run and its arrays live in VM memory, so they are freed
+        // when the run is collected. The GC copies them to the new space.
+        static m2g3_glyph_run* m2g3_glyph_run_copy(::mozart::VM vm, const m2g3_glyph_run* from) {
+            auto run = new (vm) m2g3_glyph_run (*from);
+            run->glyphs = new (vm) cairo_glyph_t[from->num_glyphs];
+            std::copy(from->glyphs, from->glyphs + from->num_glyphs, run->glyphs);
+            run->clusters = new (vm) cairo_text_cluster_t[from->num_clusters];
+            std::copy(from->clusters, from->clusters + from->num_clusters, run->clusters);
+            return run;
+        }
+    """,
+}
+
+GC_COPIED_DATATYPES = {
+    'm2g3_glyph_run': 'm2g3_glyph_run_copy',
+}
+# ^ the extra datatypes whose values are allocated in VM memory, with the
+#   function copying a value when the GC moves it.
+
+SUPPORT_INCLUDES = [
+    '<list>',
+    '<string>',
+    '<cerrno>',
+    '<cstring>',
+    '<exception>',
+    '<limits>',
+    '<unistd.h>',
+    '<algorithm>',
+    '<atomic>',
+    '<thread>',
+]
+
+SUPPORT_CODE = [
+    # LRU cache in front of cairo_scaled_font_text_to_glyphs() and
+    # cairo_text_extents(). It is disabled until shapingCacheSetLimits is called
+    # with a nonzero capacity.
+    """
+        class ShapingCache {
+        public:
+            struct Key {
+                cairo_scaled_font_t* font;
+                bool extents;
+                std::string utf8;
+
+                bool operator==(const Key& other) const {
+                    return font == other.font && extents == other.extents && utf8 == other.utf8;
+                }
+            };
+
+            struct KeyHash {
+                size_t operator()(const Key& key) const {
+                    size_t h = std::hash<std::string>()(key.utf8);
+                    h ^= std::hash<void*>()(key.font) + 0x9e3779b9 + (h << 6) + (h >> 2);
+                    h ^= key.extents + 0x9e3779b9 + (h << 6) + (h >> 2);
+                    return h;
+                }
+            };
+
+            // Glyphs are stored as shaped at the origin, so an entry can be
+            // reused wherever the text is drawn.
+            struct Entry {
+                Key key;
+                std::vector<cairo_glyph_t> glyphs;
+                std::vector<cairo_text_cluster_t> clusters;
+                cairo_text_cluster_flags_t clusterFlags;
+                cairo_text_extents_t extents;
+                size_t bytes;
+            };
+
+            static ShapingCache& instance() {
+                static ShapingCache cache;
+                return cache;
+            }
+
+            // The font options of a scaled font are fixed when it is
+            // created, and the entries of a font are evicted when it is
+            // destroyed (see watch()), so the font pointer stands for them.
+            static Key makeKey(cairo_scaled_font_t* font, bool extents, const char* utf8, int utf8_len) {
+                return Key {font, extents, utf8_len < 0 ? std::string(utf8) : std::string(utf8, utf8_len)};
+            }
+
+            // Evict the entries of a scaled font when cairo destroys it, since
+            // its address may be reused afterwards.
+            static void watch(cairo_scaled_font_t* font) {
+                static cairo_user_data_key_t key;
+                if (cairo_scaled_font_get_user_data(font, &key) == nullptr) {
+                    cairo_scaled_font_set_user_data(font, &key, font, [](void* data) {
+                        instance().evict(static_cast<cairo_scaled_font_t*>(data));
+                    });
+                }
+            }
+
+            bool enabled() {
+                std::lock_guard<std::mutex> lock (_mutex);
+                return _capacity > 0;
+            }
+
+            bool find(const Key& key, Entry& result) {
+                std::lock_guard<std::mutex> lock (_mutex);
+                auto it = _index.find(key);
+                if (it == _index.end()) {
+                    ++ _misses;
+                    return false;
+                }
+
+                ++ _hits;
+                _entries.splice(_entries.begin(), _entries, it->second);
+                result.glyphs = it->second->glyphs;
+                result.clusters = it->second->clusters;
+                result.clusterFlags = it->second->clusterFlags;
+                result.extents = it->second->extents;
+                return true;
+            }
+
+            void insert(Entry entry) {
+                entry.bytes = sizeof(Entry) + entry.key.utf8.size() +
+                              entry.glyphs.size() * sizeof(cairo_glyph_t) +
+                              entry.clusters.size() * sizeof(cairo_text_cluster_t);
+
+                std::lock_guard<std::mutex> lock (_mutex);
+                if (_capacity == 0 || _index.count(entry.key) != 0) {
+                    return;
+                }
+                if (_byteBudget != 0 && entry.bytes > _byteBudget) {
+                    return;
+                }
+
+                _bytes += entry.bytes;
+                _entries.push_front(std::move(entry));
+                _index.emplace(_entries.front().key, _entries.begin());
+                trim();
+            }
+
+            void evict(cairo_scaled_font_t* font) {
+                std::lock_guard<std::mutex> lock (_mutex);
+                for (auto it = _entries.begin(); it != _entries.end(); ) {
+                    if (it->key.font == font) {
+                        _bytes -= it->bytes;
+                        _index.erase(it->key);
+                        it = _entries.erase(it);
+                    } else {
+                        ++ it;
+                    }
+                }
+            }
+
+            void setLimits(size_t capacity, size_t byteBudget) {
+                std::lock_guard<std::mutex> lock (_mutex);
+                _capacity = capacity;
+                _byteBudget = byteBudget;
+                trim();
+            }
+
+            UnstableNode stats(VM vm) {
+                std::lock_guard<std::mutex> lock (_mutex);
+                return buildRecord(vm,
+                    buildArity(vm, MOZART_STR("shapingCache"),
+                               MOZART_STR("byteBudget"), MOZART_STR("bytes"),
+                               MOZART_STR("capacity"), MOZART_STR("entries"),
+                               MOZART_STR("hits"), MOZART_STR("misses")),
+                    _byteBudget, _bytes, _capacity, _entries.size(), _hits, _misses
+                );
+            }
+
+        private:
+            void trim() {
+                while (_entries.size() > _capacity || (_byteBudget != 0 && _bytes > _byteBudget)) {
+                    _bytes -= _entries.back().bytes;
+                    _index.erase(_entries.back().key);
+                    _entries.pop_back();
+                }
+            }
+
+            std::mutex _mutex;
+            std::list<Entry> _entries;  // most recently used first.
+            std::unordered_map<Key, std::list<Entry>::iterator, KeyHash> _index;
+            size_t _capacity = 0;
+            size_t _byteBudget = 0;
+            size_t _bytes = 0;
+            size_t _hits = 0;
+            size_t _misses = 0;
+        };
+
+        static cairo_status_t m2g3_cached_scaled_font_text_to_glyphs(
+                cairo_scaled_font_t* scaled_font, double x, double y,
+                const char* utf8, int utf8_len,
+                cairo_glyph_t** glyphs, int* num_glyphs,
+                cairo_text_cluster_t** clusters, int* num_clusters,
+                cairo_text_cluster_flags_t* cluster_flags) {
+            auto& cache = ShapingCache::instance();
+            if (utf8 == nullptr || !cache.enabled() ||
+                    cairo_scaled_font_status(scaled_font) != CAIRO_STATUS_SUCCESS) {
+                return cairo_scaled_font_text_to_glyphs(scaled_font, x, y, utf8, utf8_len,
+                                                        glyphs, num_glyphs,
+                                                        clusters, num_clusters, cluster_flags);
+            }
+
+            ShapingCache::Entry entry;
+            entry.key = ShapingCache::makeKey(scaled_font, false, utf8, utf8_len);
+            if (!cache.find(entry.key, entry)) {
+                cairo_glyph_t* cc_glyphs = nullptr;
+                cairo_text_cluster_t* cc_clusters = nullptr;
+                int cc_num_glyphs = 0, cc_num_clusters = 0;
+                auto status = cairo_scaled_font_text_to_glyphs(scaled_font, 0, 0, utf8, utf8_len,
+                                                               &cc_glyphs, &cc_num_glyphs,
+                                                               &cc_clusters, &cc_num_clusters,
+                                                               &entry.clusterFlags);
+                if (status != CAIRO_STATUS_SUCCESS) {
+                    return cairo_scaled_font_text_to_glyphs(scaled_font, x, y, utf8, utf8_len,
+                                                            glyphs, num_glyphs,
+                                                            clusters, num_clusters, cluster_flags);
+                }
+
+                entry.glyphs.assign(cc_glyphs, cc_glyphs + cc_num_glyphs);
+                entry.clusters.assign(cc_clusters, cc_clusters + cc_num_clusters);
+                cairo_glyph_free(cc_glyphs);
+                cairo_text_cluster_free(cc_clusters);
+
+                ShapingCache::watch(scaled_font);
+                cache.insert(entry);
+            }
+
+            int count = entry.glyphs.size();
+            if (*glyphs == nullptr || *num_glyphs < count) {
+                *glyphs = cairo_glyph_allocate(count);
+            }
+            for (int i = 0; i < count; ++ i) {
+                (*glyphs)[i] = entry.glyphs[i];
+                (*glyphs)[i].x += x;
+                (*glyphs)[i].y += y;
+            }
+            *num_glyphs = count;
+
+            if (clusters != nullptr) {
+                count = entry.clusters.size();
+                if (*clusters == nullptr || *num_clusters < count) {
+                    *clusters = cairo_text_cluster_allocate(count);
+                }
+                std::copy(entry.clusters.begin(), entry.clusters.end(), *clusters);
+                *num_clusters = count;
+                *cluster_flags = entry.clusterFlags;
+            }
+
+            return CAIRO_STATUS_SUCCESS;
+        }
+
+        static void m2g3_cached_text_extents(cairo_t* cr, const char* utf8, cairo_text_extents_t* extents) {
+            auto& cache = ShapingCache::instance();
+            if (utf8 == nullptr || !cache.enabled() || cairo_status(cr) != CAIRO_STATUS_SUCCESS) {
+                cairo_text_extents(cr, utf8, extents);
+                return;
+            }
+
+            auto scaled_font = cairo_get_scaled_font(cr);
+            ShapingCache::Entry entry;
+            entry.key = ShapingCache::makeKey(scaled_font, true, utf8, -1);
+            if (!cache.find(entry.key, entry)) {
+                cairo_text_extents(cr, utf8, &entry.extents);
+                if (cairo_status(cr) == CAIRO_STATUS_SUCCESS) {
+                    ShapingCache::watch(scaled_font);
+                    cache.insert(entry);
+                }
+            }
+            *extents = entry.extents;
+        }
+    """,
+
+    # LRU cache of the solid patterns set by cairo_set_source_rgb() and
+    # cairo_set_source_rgba(), so that drawing with a small palette does not
+    # create and destroy a pattern on every call. It is disabled until
+    # solidPatternCacheSetCapacity gives it a capacity.
+    #
+    # When enabled, the colour components are clamped to [0, 1] and rounded to
+    # 16 bits (the precision cairo renders with), so the source pattern has the
+    # rounded colour rather than the exact one. The pattern of a colour is
+    # shared by every context using it: changing the pattern returned by
+    # cairo_get_source() (its matrix, extend, filter or user data) affects
+    # those contexts and later calls too, so a program doing so must leave the
+    # cache disabled.
+    """
+        class SolidPatternCache {
+        public:
+            static SolidPatternCache& instance() {
+                static SolidPatternCache cache;
+                return cache;
+            }
+
+            // Return a new reference to the pattern of the colour, or nullptr
+            // if the cache is disabled.
+            cairo_pattern_t* acquire(double red, double green, double blue, double alpha) {
+                uint64_t key = (quantize(red) << 48) | (quantize(green) << 32) |
+                               (quantize(blue) << 16) | quantize(alpha);
+                cairo_pattern_t* evicted = nullptr;
+                cairo_pattern_t* pattern;
+                {
+                    std::lock_guard<std::mutex> lock (_mutex);
+                    if (_capacity == 0) {
+                        return nullptr;
+                    }
+
+                    auto it = _index.find(key);
+                    if (it != _index.end()) {
+                        ++ _hits;
+                        _entries.splice(_entries.begin(), _entries, it->second);
+                        return cairo_pattern_reference(it->second->second);
+                    }
+
+                    ++ _misses;
+                    pattern = cairo_pattern_create_rgba(
+                        (key >> 48) / 65535.0, ((key >> 32) & 0xffff) / 65535.0,
+                        ((key >> 16) & 0xffff) / 65535.0, (key & 0xffff) / 65535.0);
+                    _entries.emplace_front(key, pattern);
+                    _index.emplace(key, _entries.begin());
+                    if (_entries.size() > _capacity) {
+                        evicted = _entries.back().second;
+                        _index.erase(_entries.back().first);
+                        _entries.pop_back();
+                    }
+                    cairo_pattern_reference(pattern);
+                }
+
+                // a pattern still set as the source of a context lives on.
+                if (evicted != nullptr) {
+                    cairo_pattern_destroy(evicted);
+                }
+                return pattern;
+            }
+
+            void setCapacity(size_t capacity) {
+                std::vector<cairo_pattern_t*> evicted;
+                {
+                    std::lock_guard<std::mutex> lock (_mutex);
+                    _capacity = capacity;
+                    while (_entries.size() > _capacity) {
+                        evicted.push_back(_entries.back().second);
+                        _index.erase(_entries.back().first);
+                        _entries.pop_back();
+                    }
+                }
+
+                for (auto pattern : evicted) {
+                    cairo_pattern_destroy(pattern);
+                }
+            }
+
+            UnstableNode stats(VM vm) {
+                std::lock_guard<std::mutex> lock (_mutex);
+                return buildRecord(vm,
+                    buildArity(vm, MOZART_STR("solidPatternCache"),
+                               MOZART_STR("capacity"), MOZART_STR("entries"),
+                               MOZART_STR("hits"), MOZART_STR("misses")),
+                    _capacity, _entries.size(), _hits, _misses
+                );
+            }
+
+        private:
+            static uint64_t quantize(double component) {
+                return static_cast<uint64_t>(std::min(std::max(component, 0.0), 1.0) * 65535.0 + 0.5);
+            }
+
+            typedef std::list<std::pair<uint64_t, cairo_pattern_t*>> Lru;
+
+            std::mutex _mutex;
+            Lru _entries;   // most recently used first.
+            std::unordered_map<uint64_t, Lru::iterator> _index;
+            size_t _capacity = 0;
+            size_t _hits = 0;
+            size_t _misses = 0;
+        };
+
+        static void m2g3_cached_set_source_rgba(cairo_t* cr, double red, double green, double blue, double alpha) {
+            auto pattern = cairo_status(cr) == CAIRO_STATUS_SUCCESS ?
+                           SolidPatternCache::instance().acquire(red, green, blue, alpha) : nullptr;
+            if (pattern == nullptr) {
+                cairo_set_source_rgba(cr, red, green, blue, alpha);
+                return;
+            }
+            cairo_set_source(cr, pattern);
+            cairo_pattern_destroy(pattern);
+        }
+
+        static void m2g3_cached_set_source_rgb(cairo_t* cr, double red, double green, double blue) {
+            m2g3_cached_set_source_rgba(cr, red, green, blue, 1.0);
+        }
+    """,
+
+    # Rectangle arrays packed in byte strings (x, y, width, height per entry,
+    # in native byte order), instead of a list of records.
+    """
+        template <typename T>
+        static UnstableNode buildPacked(VM vm, const T* items, size_t count) {
+            auto data = reinterpret_cast<const unsigned char*>(items);
+            return ByteString::build(vm, newLString(vm, data, count * sizeof(T)));
+        }
+
+        template <typename T>
+        static std::vector<T> unbuildPacked(VM vm, RichNode packed) {
+            if (packed.isTransient()) {
+                waitFor(vm, packed);
+            }
+            if (!packed.is<ByteString>()) {
+                raiseTypeError(vm, MOZART_STR("ByteString"), packed);
+            }
+            auto value = packed.as<ByteString>().value();
+            if (value.length % sizeof(T) != 0) {
+                raiseTypeError(vm, MOZART_STR("packed rectangles"), packed);
+            }
+            std::vector<T> items (value.length / sizeof(T));
+            memcpy(items.data(), value.string, value.length);
+            return items;
+        }
+    """,
+
+    # Closures of cairo_surface_write_to_png_stream() and
+    # cairo_image_surface_create_from_png_stream(). The PNG is exchanged in
+    # bounded pieces with either a file descriptor (an integer) or Oz byte
+    # strings: chunks are sent to a port, and read from a list of byte strings.
+    # No exception may unwind through cairo and libpng: an exception raised
+    # while sending a chunk fails the write, and is raised again by rethrow()
+    # once cairo has returned.
+    """
+        class PngSink {
+        public:
+            PngSink(VM vm, RichNode sink, size_t chunkSize)
+                : _vm(vm), _port(sink), _fd(-1), _chunkSize(std::max<size_t>(chunkSize, 1)) {
+                if (sink.isTransient()) {
+                    waitFor(vm, sink);
+                }
+                if (sink.is<SmallInt>()) {
+                    auto fd = sink.as<SmallInt>().value();
+                    if (fd < 0 || fd > std::numeric_limits<int>::max()) {
+                        raiseTypeError(vm, MOZART_STR("Port or file descriptor"), sink);
+                    }
+                    _fd = static_cast<int>(fd);
+                } else if (!sink.is<Port>()) {
+                    raiseTypeError(vm, MOZART_STR("Port or file descriptor"), sink);
+                }
+            }
+
+            static cairo_status_t write(void* closure, const unsigned char* data, unsigned int length) {
+                auto self = static_cast<PngSink*>(closure);
+                try {
+                    self->_buffer.insert(self->_buffer.end(), data, data + length);
+                    while (self->_buffer.size() >= self->_chunkSize) {
+                        if (!self->emit(self->_chunkSize)) {
+                            return CAIRO_STATUS_WRITE_ERROR;
+                        }
+                    }
+                } catch (...) {
+                    self->_exception = std::current_exception();
+                    return CAIRO_STATUS_WRITE_ERROR;
+                }
+                return CAIRO_STATUS_SUCCESS;
+            }
+
+            void rethrow() {
+                if (_exception) {
+                    std::rethrow_exception(_exception);
+                }
+            }
+
+            cairo_status_t flush() {
+                if (!_buffer.empty() && !emit(_buffer.size())) {
+                    return CAIRO_STATUS_WRITE_ERROR;
+                }
+                return CAIRO_STATUS_SUCCESS;
+            }
+
+        private:
+            bool emit(size_t length) {
+                if (_fd >= 0) {
+                    size_t written = 0;
+                    while (written < length) {
+                        auto res = ::write(_fd, _buffer.data() + written, length - written);
+                        if (res == 0 || (res < 0 && errno != EINTR)) {
+                            return false;
+                        } else if (res > 0) {
+                            written += res;
+                        }
+                    }
+                } else {
+                    auto chunk = ByteString::build(_vm, newLString(_vm, _buffer.data(), length));
+                    PortLike(_port).send(_vm, chunk);
+                }
+                _buffer.erase(_buffer.begin(), _buffer.begin() + length);
+                return true;
+            }
+
+            VM _vm;
+            RichNode _port;
+            int _fd;
+            size_t _chunkSize;
+            std::vector<unsigned char> _buffer;
+            std::exception_ptr _exception;
+        };
+
+        class PngSource {
+        public:
+            // A list source must be complete (e.g. a closed port stream),
+            // since cairo cannot be suspended while waiting for more data.
+            PngSource(VM vm, RichNode source) : _fd(-1), _current(0), _offset(0) {
+                if (source.isTransient()) {
+                    waitFor(vm, source);
+                }
+                if (source.is<SmallInt>()) {
+                    auto fd = source.as<SmallInt>().value();
+                    if (fd < 0 || fd > std::numeric_limits<int>::max()) {
+                        raiseTypeError(vm, MOZART_STR("list of ByteStrings or file descriptor"), source);
+                    }
+                    _fd = static_cast<int>(fd);
+                    return;
+                }
+                ozListForEach(vm, source, [vm, this](UnstableNode& node) {
+                    RichNode chunk = node;
+                    if (chunk.isTransient()) {
+                        waitFor(vm, chunk);
+                    }
+                    if (!chunk.is<ByteString>()) {
+                        raiseTypeError(vm, MOZART_STR("ByteString"), chunk);
+                    }
+                    _chunks.push_back(chunk.as<ByteString>().value());
+                }, MOZART_STR("list of ByteStrings"));
+            }
+
+            static cairo_status_t read(void* closure, unsigned char* data, unsigned int length) {
+                auto self = static_cast<PngSource*>(closure);
+                while (length > 0) {
+                    size_t count;
+                    if (self->_fd >= 0) {
+                        auto res = ::read(self->_fd, data, length);
+                        if (res == 0 || (res < 0 && errno != EINTR)) {
+                            return CAIRO_STATUS_READ_ERROR;
+                        }
+                        count = std::max<decltype(res)>(res, 0);
+                    } else {
+                        if (self->_current >= self->_chunks.size()) {
+                            return CAIRO_STATUS_READ_ERROR;
+                        }
+                        auto& chunk = self->_chunks[self->_current];
+                        count = std::min<size_t>(length, chunk.length - self->_offset);
+                        memcpy(data, chunk.string + self->_offset, count);
+                        self->_offset += count;
+                        if (self->_offset == static_cast<size_t>(chunk.length)) {
+                            ++ self->_current;
+                            self->_offset = 0;
+                        }
+                    }
+                    data += count;
+                    length -= count;
+                }
+                return CAIRO_STATUS_SUCCESS;
+            }
+
+        private:
+            int _fd;
+            std::vector<LString<unsigned char>> _chunks;
+            size_t _current;
+            size_t _offset;
+        };
+    """,
+
+    # Replays a recording surface into an image surface using one thread per
+    # core. Every tile is an image surface over a disjoint part of the target's
+    # pixels, so the tiles are composited in place without copying. cairo does
+    # not make the concurrent replay of one recording surface safe (its lazily
+    # built state is not locked), so every thread replays its own copy of the
+    # commands, made from the original on the calling thread first. The
+    # threads only share the sources referenced by the recorded commands,
+    # which they read; recording surfaces painted into the recording are among
+    # them, so such recordings must not be replayed tiled.
+    """
+        // Painting a surface into a recording records a snapshot of it, which
+        // refers to the surface until the surface is flushed: the flush makes
+        // the snapshot copy the commands of the recording. The next copy then
+        // gets a new snapshot, so the copies share no commands. (The flush
+        // also detaches the mime data of the recording.)
+        static cairo_surface_t* m2g3_recording_surface_copy(cairo_surface_t* recording) {
+            cairo_rectangle_t extents;
+            bool bounded = cairo_recording_surface_get_extents(recording, &extents);
+            auto copy = cairo_recording_surface_create(cairo_surface_get_content(recording),
+                                                       bounded ? &extents : nullptr);
+            auto cr = cairo_create(copy);
+            cairo_set_source_surface(cr, recording, 0, 0);
+            cairo_paint(cr);
+            cairo_destroy(cr);
+            cairo_surface_flush(recording);
+            return copy;
+        }
+
+        static cairo_status_t m2g3_recording_surface_replay_tiled(
+                cairo_surface_t* recording, cairo_surface_t* target, int tile_size) {
+            if (cairo_surface_get_type(recording) != CAIRO_SURFACE_TYPE_RECORDING ||
+                    cairo_surface_get_type(target) != CAIRO_SURFACE_TYPE_IMAGE) {
+                return CAIRO_STATUS_SURFACE_TYPE_MISMATCH;
+            }
+
+            cairo_surface_flush(target);
+            auto format = cairo_image_surface_get_format(target);
+            auto data = cairo_image_surface_get_data(target);
+            int width = cairo_image_surface_get_width(target);
+            int height = cairo_image_surface_get_height(target);
+            int stride = cairo_image_surface_get_stride(target);
+            double x_offset, y_offset;
+            cairo_surface_get_device_offset(target, &x_offset, &y_offset);
+
+            int bytes_per_pixel = 0;
+            switch (format) {
+                case CAIRO_FORMAT_ARGB32:
+                case CAIRO_FORMAT_RGB24:
+                case CAIRO_FORMAT_RGB30:
+                    bytes_per_pixel = 4;
+                    break;
+                case CAIRO_FORMAT_RGB16_565:
+                    bytes_per_pixel = 2;
+                    break;
+                case CAIRO_FORMAT_A8:
+                    bytes_per_pixel = 1;
+                    break;
+                default:
+                    break;
+            }
+
+            if (bytes_per_pixel == 0 || data == nullptr || tile_size <= 0) {
+                auto cr = cairo_create(target);
+                cairo_set_source_surface(cr, recording, 0, 0);
+                cairo_paint(cr);
+                auto status = cairo_status(cr);
+                cairo_destroy(cr);
+                return status;
+            }
+
+            // keep the rows of every tile 4-byte aligned.
+            tile_size = std::min(tile_size, std::max(std::max(width, height), 1));
+            tile_size = (tile_size + 3) & ~3;
+            int columns = (width + tile_size - 1) / tile_size;
+            int tiles = columns * ((height + tile_size - 1) / tile_size);
+            if (tiles == 0) {
+                return CAIRO_STATUS_SUCCESS;
+            }
+            std::atomic<int> next_tile (0);
+            std::atomic<int> result (CAIRO_STATUS_SUCCESS);
+
+            int thread_count = std::min<int>(std::max(std::thread::hardware_concurrency(), 1u), tiles);
+            std::vector<cairo_surface_t*> copies;
+            for (int i = 0; i < thread_count; ++ i) {
+                copies.push_back(m2g3_recording_surface_copy(recording));
+                auto status = cairo_surface_status(copies.back());
+                if (status != CAIRO_STATUS_SUCCESS) {
+                    for (auto copy : copies) {
+                        cairo_surface_destroy(copy);
+                    }
+                    return status;
+                }
+            }
+
+            auto worker = [&](cairo_surface_t* copy) {
+                int i;
+                while ((i = next_tile++) < tiles) {
+                    int x = (i % columns) * tile_size;
+                    int y = (i / columns) * tile_size;
+                    auto tile = cairo_image_surface_create_for_data(
+                        data + y * stride + x * bytes_per_pixel, format,
+                        std::min(tile_size, width - x), std::min(tile_size, height - y), stride);
+                    // the target's device offset, moved to the tile's origin.
+                    cairo_surface_set_device_offset(tile, x_offset - x, y_offset - y);
+                    auto cr = cairo_create(tile);
+                    cairo_set_source_surface(cr, copy, 0, 0);
+                    cairo_paint(cr);
+                    auto status = cairo_status(cr);
+                    cairo_destroy(cr);
+                    cairo_surface_destroy(tile);
+                    if (status != CAIRO_STATUS_SUCCESS) {
+                        result = status;
+                    }
+                }
+            };
+
+            std::vector<std::thread> threads;
+            for (int i = 1; i < thread_count; ++ i) {
+                threads.emplace_back(worker, copies[i]);
+            }
+            worker(copies[0]);
+            for (auto& thread : threads) {
+                thread.join();
+            }
+            for (auto copy : copies) {
+                cairo_surface_destroy(copy);
+            }
+
+            cairo_surface_mark_dirty(target);
+            return static_cast<cairo_status_t>(result.load());
+        }
+    """,
+
+    # Pool of the pixel buffers of the image surfaces created by
+    # imageSurfacePoolAcquire. Every acquired surface is a new cairo surface
+    # over a pooled buffer, so no user data, mime data or surface settings
+    # carry over; its buffer goes back to the pool when cairo destroys it (e.g.
+    # by imageSurfacePoolRelease), and is reused with the same format and size.
+    # The pixels are only cleared if asked: a caller which overwrites the whole
+    # surface (e.g. by painting with the SOURCE operator) passes false, and
+    # gets a surface holding arbitrary pixels.
+    # The least recently returned buffers are freed when the retained bytes
+    # exceed the budget.
+    """
+        class ImageSurfacePool {
+        public:
+            static ImageSurfacePool& instance() {
+                static ImageSurfacePool pool;
+                return pool;
+            }
+
+            cairo_surface_t* acquire(cairo_format_t format, int width, int height, bool clear) {
+                int stride = cairo_format_stride_for_width(format, width);
+                if (stride < 0 || width <= 0 || height <= 0) {
+                    return cairo_image_surface_create(format, width, height);
+                }
+
+                Buffer* buffer = nullptr;
+                {
+                    std::lock_guard<std::mutex> lock (_mutex);
+                    auto it = _free.find(Key {format, width, height});
+                    if (it != _free.end()) {
+                        ++ _hits;
+                        buffer = it->second->second;
+                        _bytes -= buffer->bytes;
+                        _lru.erase(it->second);
+                        _free.erase(it);
+                    } else {
+                        ++ _misses;
+                    }
+                }
+
+                if (buffer == nullptr) {
+                    buffer = new Buffer {Key {format, width, height},
+                                         static_cast<size_t>(stride) * height, nullptr};
+                    buffer->data.reset(new unsigned char[buffer->bytes]);
+                }
+
+                if (clear) {
+                    memset(buffer->data.get(), 0, buffer->bytes);
+                }
+                auto surface = cairo_image_surface_create_for_data(buffer->data.get(), format, width, height, stride);
+                if (cairo_surface_set_user_data(surface, &bufferKey(), buffer, &returnBuffer) != CAIRO_STATUS_SUCCESS) {
+                    cairo_surface_destroy(surface);
+                    delete buffer;
+                    return cairo_image_surface_create(format, width, height);
+                }
+                return surface;
+            }
+
+            void release(cairo_surface_t* surface) {
+                cairo_surface_destroy(surface);
+            }
+
+            void setBudget(size_t budget) {
+                std::vector<Buffer*> evicted;
+                {
+                    std::lock_guard<std::mutex> lock (_mutex);
+                    _budget = budget;
+                    trim(evicted);
+                }
+
+                for (auto buffer : evicted) {
+                    delete buffer;
+                }
+            }
+
+            UnstableNode stats(VM vm) {
+                std::lock_guard<std::mutex> lock (_mutex);
+                size_t requests = _hits + _misses;
+                double hit_rate = requests == 0 ? 0.0 : static_cast<double>(_hits) / requests;
+                return buildRecord(vm,
+                    buildArity(vm, MOZART_STR("imageSurfacePool"),
+                               MOZART_STR("budget"), MOZART_STR("bytesRetained"),
+                               MOZART_STR("hitRate"), MOZART_STR("hits"),
+                               MOZART_STR("misses"), MOZART_STR("surfaces")),
+                    _budget, _bytes, hit_rate, _hits, _misses, _lru.size()
+                );
+            }
+
+        private:
+            struct Key {
+                cairo_format_t format;
+                int width;
+                int height;
+
+                bool operator==(const Key& other) const {
+                    return format == other.format && width == other.width && height == other.height;
+                }
+            };
+
+            struct KeyHash {
+                size_t operator()(const Key& key) const {
+                    return (static_cast<size_t>(key.format) * 31 + key.width) * 65599 + key.height;
+                }
+            };
+
+            struct Buffer {
+                Key key;
+                size_t bytes;
+                std::unique_ptr<unsigned char[]> data;
+            };
+
+            typedef std::list<std::pair<Key, Buffer*>> Lru;
+
+            static cairo_user_data_key_t& bufferKey() {
+                static cairo_user_data_key_t key;
+                return key;
+            }
+
+            // Called by cairo when the last reference to a pooled surface
+            // is dropped, possibly on another thread.
+            static void returnBuffer(void* data) {
+                instance().recycle(static_cast<Buffer*>(data));
+            }
+
+            void recycle(Buffer* buffer) {
+                std::vector<Buffer*> evicted;
+                {
+                    std::lock_guard<std::mutex> lock (_mutex);
+                    _lru.emplace_front(buffer->key, buffer);
+                    _free.emplace(buffer->key, _lru.begin());
+                    _bytes += buffer->bytes;
+                    trim(evicted);
+                }
+
+                for (auto evicted_buffer : evicted) {
+                    delete evicted_buffer;
+                }
+            }
+
+            void trim(std::vector<Buffer*>& evicted) {
+                while (_bytes > _budget) {
+                    auto buffer = _lru.back().second;
+                    auto range = _free.equal_range(_lru.back().first);
+                    for (auto it = range.first; it != range.second; ++ it) {
+                        if (it->second->second == buffer) {
+                            _free.erase(it);
+                            break;
+                        }
+                    }
+                    _lru.pop_back();
+                    _bytes -= buffer->bytes;
+                    evicted.push_back(buffer);
+                }
+            }
+
+            std::mutex _mutex;
+            Lru _lru;   // most recently returned first.
+            std::unordered_multimap<Key, Lru::iterator, KeyHash> _free;
+            size_t _budget = 64 << 20;
+            size_t _bytes = 0;
+            size_t _hits = 0;
+            size_t _misses = 0;
+        };
+    """,
+]
+
+EXTRA_FUNCTIONS = {
+    'cairo': {
+        'wrappedNodeStats':
+            (', Out result', """
+                result = WrappedNode::stats(vm);
+            """),
+        'scaledFontTextToGlyphRun':
+            (', In scaledFont, In x, In y, In utf8, Out status, Out run', """
+                cairo_scaled_font_t* cc_scaled_font;
+                unbuild(vm, scaledFont, cc_scaled_font);
+                double cc_x, cc_y;
+                unbuild(vm, x, cc_x);
+                unbuild(vm, y, cc_y);
+                const char* cc_utf8;
+                unbuild(vm, utf8, cc_utf8);
+                m2g3_glyph_run cc_run {};
+                auto cc_status = m2g3_cached_scaled_font_text_to_glyphs(
+                    cc_scaled_font, cc_x, cc_y, cc_utf8, -1,
+                    &cc_run.glyphs, &cc_run.num_glyphs,
+                    &cc_run.clusters, &cc_run.num_clusters,
+                    &cc_run.cluster_flags);
+                status = build(vm, cc_status);
+                if (cc_status == CAIRO_STATUS_SUCCESS) {
+                    run = build(vm, m2g3_glyph_run_copy(vm, &cc_run));
+                } else {
+                    run = ::mozart::build(vm, ::mozart::unit);
+                }
+                cairo_glyph_free(cc_run.glyphs);
+                cairo_text_cluster_free(cc_run.clusters);
+            """),
+        'shapingCacheSetLimits':
+            (', In capacity, In byteBudget', """
+                size_t cc_capacity, cc_byte_budget;
+                unbuild(vm, capacity, cc_capacity);
+                unbuild(vm, byteBudget, cc_byte_budget);
+                ShapingCache::instance().setLimits(cc_capacity, cc_byte_budget);
+            """),
+        'shapingCacheStats':
+            (', Out result', """
+                result = ShapingCache::instance().stats(vm);
+            """),
+        'solidPatternCacheSetCapacity':
+            (', In capacity', """
+                size_t cc_capacity;
+                unbuild(vm, capacity, cc_capacity);
+                SolidPatternCache::instance().setCapacity(cc_capacity);
+            """),
+        'solidPatternCacheStats':
+            (', Out result', """
+                result = SolidPatternCache::instance().stats(vm);
+            """),
+        # The rectangles of the *Packed builtins are byte strings of 4 numbers
+        # per rectangle, x, y, width and height, laid out as in memory: doubles
+        # (cairo_rectangle_t) for copyClipRectangleListPacked, 32-bit integers
+        # (cairo_rectangle_int_t) for the region builtins, in the native byte
+        # order. They are not portable across machines; count is the number of
+        # rectangles.
+        'copyClipRectangleListPacked':
+            (', In cr, Out status, Out rectangles, Out count', """
+                cairo_t* cc_cr;
+                unbuild(vm, cr, cc_cr);
+                WorkerPool::waitIdle({cc_cr});
+                auto cc_list = cairo_copy_clip_rectangle_list(cc_cr);
+                status = build(vm, cc_list->status);
+                rectangles = buildPacked(vm, cc_list->rectangles, cc_list->num_rectangles);
+                count = build(vm, cc_list->num_rectangles);
+                cairo_rectangle_list_destroy(cc_list);
+            """),
+        'regionGetRectanglesPacked':
+            (', In region, Out rectangles, Out count', """
+                cairo_region_t* cc_region;
+                unbuild(vm, region, cc_region);
+                std::vector<cairo_rectangle_int_t> cc_rectangles (cairo_region_num_rectangles(cc_region));
+                for (size_t i = 0; i < cc_rectangles.size(); ++ i) {
+                    cairo_region_get_rectangle(cc_region, i, &cc_rectangles[i]);
+                }
+                rectangles = buildPacked(vm, cc_rectangles.data(), cc_rectangles.size());
+                count = build(vm, cc_rectangles.size());
+            """),
+        'regionCreateRectanglesPacked':
+            (', In rectangles, Out region', """
+                auto cc_rectangles = unbuildPacked<cairo_rectangle_int_t>(vm, rectangles);
+                region = build(vm, cairo_region_create_rectangles(cc_rectangles.data(), cc_rectangles.size()));
+            """),
+        'recordingSurfaceReplayTiled':
+            (', In recording, In target, In tileSize, Out status', """
+                cairo_surface_t* cc_recording;
+                cairo_surface_t* cc_target;
+                int cc_tile_size;
+                unbuild(vm, recording, cc_recording);
+                unbuild(vm, target, cc_target);
+                unbuild(vm, tileSize, cc_tile_size);
+                WorkerPool::waitIdle({cc_recording, cc_target});
+                auto cc_status = m2g3_recording_surface_replay_tiled(cc_recording, cc_target, cc_tile_size);
+                status = build(vm, cc_status);
+            """),
+        'imageSurfacePoolAcquire':
+            (', In format, In width, In height, In clear, Out surface', """
+                cairo_format_t cc_format;
+                int cc_width, cc_height;
+                bool cc_clear;
+                unbuild(vm, format, cc_format);
+                unbuild(vm, width, cc_width);
+                unbuild(vm, height, cc_height);
+                unbuild(vm, clear, cc_clear);
+                surface = build(vm, ImageSurfacePool::instance().acquire(cc_format, cc_width, cc_height, cc_clear));
+            """),
+        'imageSurfacePoolRelease':
+            (', In surface', """
+                cairo_surface_t* cc_surface;
+                unbuild(vm, surface, cc_surface);
+                WorkerPool::waitIdle({cc_surface});
+                ImageSurfacePool::instance().release(cc_surface);
+            """),
+        'imageSurfacePoolSetBudget':
+            (', In budget', """
+                size_t cc_budget;
+                unbuild(vm, budget, cc_budget);
+                ImageSurfacePool::instance().setBudget(cc_budget);
+            """),
+        'imageSurfacePoolStats':
+            (', Out result', """
+                result = ImageSurfacePool::instance().stats(vm);
+            """),
+        'glyphRunGlyphs':
+            (', In run, Out glyphs', """
+                m2g3_glyph_run* cc_run;
+                unbuild(vm, run, cc_run);
+                glyphs = buildDynamicList(vm, cc_run->glyphs, cc_run->glyphs + cc_run->num_glyphs);
+            """),
+        'glyphRunClusters':
+            (', In run, Out clusters, Out clusterFlags', """
+                m2g3_glyph_run* cc_run;
+                unbuild(vm, run, cc_run);
+                clusters = buildDynamicList(vm, cc_run->clusters, cc_run->clusters + cc_run->num_clusters);
+                clusterFlags = build(vm, cc_run->cluster_flags);
+            """),
+        'glyphRunDestroy':
+            (', In run', """
+                // the memory is reclaimed by the GC; the run is only emptied,
+                // so destroying it again or using it afterwards is harmless.
+                m2g3_glyph_run* cc_run;
+                unbuild(vm, run, cc_run);
+                *cc_run = m2g3_glyph_run {};
+            """),
+    },
+}
+
 FLAGS = [re.compile(p) for p in [
     '_cairo_text_cluster_flags$',
     'GHookFlagMask$',
@@ -1,14 +1,16 @@
-from textwrap import dedent
-
 class CCFormatter:
     """
     A class to format C++ source code. For now, it will only fix indentation of
     code by counting '{' and '}'s.
+
+    If a *stream* is given, the formatted code is written to it as soon as it is
+    produced, instead of being kept in the formatter.
     """
 
-    def __init__(self):
+    def __init__(self, stream=None):
         self._lines = []
         self._indent = ""
+        self._stream = stream
 
     def write(self, lines):
         """
@@ -17,28 +19,33 @@ class CCFormatter:
         """
         strip_lines = lines.strip()
         if strip_lines:
-            for line in strip_lines.split('\n'):
-                self._add(line.strip())
+            formatted = [self._format(line.strip()) for line in strip_lines.split('\n')]
+            if self._stream is not None:
+                self._stream.write(''.join(formatted))
+            else:
+                self._lines.extend(formatted)
 
-    def _add(self, line):
+    def _format(self, line):
         if not line:
-            self._lines.append('\n')
-            return
-        open_braces = sum(1 for c in line if c in '{[(')
-        close_braces = sum(1 for c in line if c in ')]}')
+            return '\n'
+        count = line.count
+        open_braces = count('{') + count('[') + count('(')
+        close_braces = count('}') + count(']') + count(')')
         indent_string = self._indent
         if line[0] == '}':
             indent_string = indent_string[4:]
         if close_braces > open_braces:
             self._indent = self._indent[4:]
-        self._lines.extend((indent_string, line, '\n'))
-        if open_braces > close_braces:
+        elif open_braces > close_braces:
             self._indent += "    "
+        return indent_string + line + '\n'
 
     def __str__(self):
         """
-        Extract the content of the formatter as a string.
+        Extract the content of the formatter as a string. Not available if the
+        formatter writes to a stream.
         """
+        assert self._stream is None
         result = "".join(self._lines)
         self._lines = [result]
         return result
@@ -47,7 +54,7 @@ class CCFormatter:
     def lines(self):
         """
         Extract the content of the formatter as an iterable of strings. The
-        iterable can be concatenated.
+        iterable can be concatenated. It is empty if the formatter writes to a
+        stream.
         """
         return self._lines
-
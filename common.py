@@ -1,20 +1,9 @@
 import re
+import zlib
 from clang.cindex import CursorKind, TypeKind, Cursor
 from collections import defaultdict
 
-C_FILES = 'c-files'
-C_EXT = '.c'
-SRC = 'src'
-CC_EXT = '.cc'
-HH_EXT = '.hh'
-OUT_EXT = '.out'
-
-TYPES_HH_EXT = '-types.hh'
-TYPES_DECL_HH_EXT = '-types-decl.hh'
-MODULES_HH_EXT = '-modules.hh'
-BUILDERS_HH_EXT = '-builders.hh'
-BUILTINS_HH_EXT = 'builtins.hh'
-BUILTINS_CC_EXT = 'builtins.cc'
+from paths import *
 
 #-------------------------------------------------------------------------------
 
@@ -120,6 +109,8 @@ def name_of(node):
     spelling = node.spelling.decode('utf-8')
     if spelling:
         return spelling
+    if node.translation_unit is None:
+        return ''
 
     typedef_node = Cursor.from_location(node.translation_unit, node.extent.end)
     if typedef_node.kind == CursorKind.TYPEDEF_DECL:
@@ -143,6 +134,13 @@ def oz_out_name_of(name):
 
 CC_NAME_OF_RETURN = cc_name_of('return')
 
+def trace_opcode_of(c_func_name):
+    """
+    Get the opcode of a C function in the call traces. It only depends on the
+    name, so it is the same whether the builtin is rendered or cached.
+    """
+    return zlib.crc32(c_func_name.encode('utf-8')) & 0xffffffff
+
 #-------------------------------------------------------------------------------
 
 def group_by(iterable, keyfunc):
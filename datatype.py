@@ -3,14 +3,18 @@ from writer import Writer
 from common import SRC, C_FILES, TYPES_DECL_HH_EXT, TYPES_HH_EXT, C_FILES, C_EXT
 
 class DataTypeDeclWriter(Writer):
-    def __init__(self, basename, constants):
+    def __init__(self, basename, constants, headers=None, shared_basename=None):
         super().__init__(join(SRC, basename + TYPES_DECL_HH_EXT))
-        self._header = basename
+        self._headers = headers or [basename]
+        self._shared_basename = shared_basename
         self._concrete_opaque_structs = constants.CONCRETE_OPAQUE_STRUCTS
 
     def write_prolog(self):
         super().write_prolog()
-        self.write('#include "../' + C_FILES + '/' + self._header + C_EXT + '"')
+        if self._shared_basename is not None:
+            self.write('#include "' + self._shared_basename + TYPES_DECL_HH_EXT + '"')
+        for header in self._headers:
+            self.write('#include "../' + C_FILES + '/' + header + C_EXT + '"')
         self.write('#include <mozart.hh>')
 
     def write_epilog(self):
@@ -91,13 +95,17 @@ class DataTypeDeclWriter(Writer):
 
 
 class DataTypeWriter(Writer):
-    def __init__(self, basename, constants):
+    def __init__(self, basename, constants, shared_basename=None):
         super().__init__(join(SRC, basename + TYPES_HH_EXT))
         self._basename = basename
+        self._shared_basename = shared_basename
         self._concrete_opaque_structs = constants.CONCRETE_OPAQUE_STRUCTS
+        self._gc_copied_datatypes = constants.GC_COPIED_DATATYPES
 
     def write_prolog(self):
         super().write_prolog()
+        if self._shared_basename is not None:
+            self.write('#include "' + self._shared_basename + TYPES_HH_EXT + '"')
         self.write('#include "' + self._basename + TYPES_DECL_HH_EXT + '"')
 
     def write_epilog(self):
@@ -115,15 +123,17 @@ class DataTypeWriter(Writer):
         """.format(struct_name))
 
         if struct_name not in self._concrete_opaque_structs:
+            gc_copy = self._gc_copied_datatypes.get(struct_name)
+            copy = 'from.get().value()' if gc_copy is None else gc_copy + '(vm, from.get().value())'
             self.write("""
                 namespace m2g3 {{
                     void D_{0}::create({0}*& self, ::mozart::VM vm, ::mozart::GR gr, Self from) {{
-                        self = from.get().value();
+                        self = {1};
                     }}
 
                     void D_{0}::printReprToStream(Self self, ::mozart::VM vm, std::ostream& out, int depth) {{
                         out << "<D_{0}: " << value() << ">";
                     }}
                 }}
-            """.format(struct_name))
+            """.format(struct_name, copy))
 
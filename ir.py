@@ -0,0 +1,164 @@
+# A compact intermediate representation of the collected clang nodes.
+#
+# The classes below mimic the part of the clang Cursor and Type interface used
+# by the generator (like fake_type.py does), so the writers can run on them
+# unchanged. They keep only names, spelled types, kinds, enum values and
+# children, and hold no reference to libclang, so the translation unit can be
+# released once the nodes are extracted, and the IR can be pickled.
+
+from clang.cindex import CursorKind, TypeKind
+from common import name_of
+
+_POINTER_KINDS = {
+    TypeKind.POINTER, TypeKind.OBJCOBJECTPOINTER, TypeKind.BLOCKPOINTER,
+    TypeKind.LVALUEREFERENCE, TypeKind.RVALUEREFERENCE
+}
+
+_DECLARED_KINDS = {
+    TypeKind.TYPEDEF, TypeKind.RECORD, TypeKind.ENUM, TypeKind.UNEXPOSED,
+    TypeKind.OBJCINTERFACE
+}
+
+_CONTAINER_KINDS = {
+    CursorKind.STRUCT_DECL, CursorKind.UNION_DECL, CursorKind.ENUM_DECL,
+    CursorKind.FUNCTION_DECL
+}
+
+_TYPED_KINDS = {CursorKind.PARM_DECL, CursorKind.FIELD_DECL, CursorKind.FUNCTION_DECL}
+
+#-------------------------------------------------------------------------------
+
+class _File:
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+class _Location:
+    __slots__ = ('file',)
+
+    def __init__(self, file):
+        self.file = file
+
+
+class CursorIR:
+    __slots__ = ('_kind', 'spelling', 'displayname', '_file', 'type',
+                 'result_type', 'enum_value', '_is_definition', '_children')
+
+    translation_unit = None
+    extent = None
+
+    @property
+    def kind(self):
+        return CursorKind.from_id(self._kind)
+
+    @property
+    def location(self):
+        return _Location(None if self._file is None else _File(self._file))
+
+    def get_children(self):
+        return iter(self._children)
+
+    def is_definition(self):
+        return self._is_definition
+
+
+class TypeIR:
+    __slots__ = ('_kind', '_qualifiers', '_canonical', '_pointee', '_declaration',
+                 'element_type', 'element_count', '_result', '_arguments', '_is_variadic')
+
+    @property
+    def kind(self):
+        return TypeKind.from_id(self._kind)
+
+    def get_canonical(self):
+        return self if self._canonical is None else self._canonical
+
+    def is_const_qualified(self):
+        return 'c' in self._qualifiers
+
+    def is_volatile_qualified(self):
+        return 'v' in self._qualifiers
+
+    def is_restrict_qualified(self):
+        return 'r' in self._qualifiers
+
+    def get_pointee(self):
+        return self._pointee
+
+    def get_declaration(self):
+        return self._declaration
+
+    def get_result(self):
+        return self._result
+
+    def argument_types(self):
+        return self._arguments
+
+    def is_function_variadic(self):
+        return self._is_variadic
+
+#-------------------------------------------------------------------------------
+
+class Extractor:
+    """
+    Convert clang cursors to the IR. Declarations are memoized, so every
+    declaration is converted once even if several types refer to it.
+    """
+
+    def __init__(self):
+        self._cursors = {}
+
+    def cursor(self, node):
+        location = node.location
+        source_file = location.file
+        file_name = None if source_file is None else source_file.name
+        key = (node.kind.value, file_name, location.line, location.column, node.spelling)
+
+        ir = self._cursors.get(key)
+        if ir is not None:
+            return ir
+
+        ir = CursorIR()
+        self._cursors[key] = ir
+        kind = node.kind
+        ir._kind = kind.value
+        ir._file = file_name
+        ir.spelling = name_of(node).encode('utf-8')
+        ir.displayname = node.displayname or ir.spelling
+        ir.type = self.type(node.type) if kind in _TYPED_KINDS else None
+        ir.result_type = self.type(node.result_type) if kind == CursorKind.FUNCTION_DECL else None
+        ir.enum_value = node.enum_value if kind == CursorKind.ENUM_CONSTANT_DECL else None
+        ir._is_definition = kind in _CONTAINER_KINDS and node.is_definition()
+        ir._children = []
+        if kind in _CONTAINER_KINDS:
+            ir._children = [self.cursor(child) for child in node.get_children()]
+        return ir
+
+    def type(self, typ, is_canonical=False):
+        ir = TypeIR()
+        kind = typ.kind
+        ir._kind = kind.value
+        ir._qualifiers = ''.join(q for q, f in (('c', typ.is_const_qualified),
+                                                ('v', typ.is_volatile_qualified),
+                                                ('r', typ.is_restrict_qualified)) if f())
+        ir._canonical = None if is_canonical else self.type(typ.get_canonical(), True)
+        ir._pointee = self.type(typ.get_pointee()) if kind in _POINTER_KINDS else None
+        ir._declaration = self.cursor(typ.get_declaration()) if kind in _DECLARED_KINDS else None
+        ir.element_type = None
+        ir.element_count = None
+        if kind in {TypeKind.CONSTANTARRAY, TypeKind.COMPLEX}:
+            ir.element_type = self.type(typ.element_type)
+        if kind == TypeKind.CONSTANTARRAY:
+            ir.element_count = typ.element_count
+        ir._result = None
+        ir._arguments = []
+        ir._is_variadic = False
+        if kind == TypeKind.FUNCTIONPROTO:
+            ir._result = self.type(typ.get_result())
+            ir._arguments = [self.type(arg) for arg in typ.argument_types()]
+            ir._is_variadic = typ.is_function_variadic()
+        return ir
+
+
+__all__ = ['Extractor', 'CursorIR', 'TypeIR']
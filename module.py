@@ -5,9 +5,16 @@ from common import *
 
 
 class ModuleHeaderWriter(Writer):
-    def __init__(self, basename):
+    def __init__(self, basename, lazy=False):
+        """
+        Create the writer of the module header. If *lazy* is true, the builtins
+        of a module are declared in a separate ``L_<mod>`` struct, and the
+        module itself only exports the ``lookup`` and ``names`` builtins, which
+        create a builtin from the static table on first lookup.
+        """
         super().__init__(join(SRC, basename + HH_EXT))
         self._basename = basename
+        self._lazy = lazy
 
     def write_prolog(self):
         super().write_prolog()
@@ -29,12 +36,34 @@ class ModuleHeaderWriter(Writer):
 
     @contextmanager
     def write_module(self, modname):
+        if not self._lazy:
+            self.write("""
+                    struct M_{0} : Module {{
+                        M_{0}() : Module("{0}") {{ }}
+            """.format(modname))
+            yield
+            self.write("};")    # }
+            return
+
+        self.write("struct L_{0} {{".format(modname))    # }
+        yield
         self.write("""
+                }};
+
                 struct M_{0} : Module {{
                     M_{0}() : Module("{0}") {{ }}
+
+                    struct P_lookup : Builtin<P_lookup> {{
+                        P_lookup() : Builtin("lookup") {{ }}
+                        void operator()(VM vm, In name, Out result);
+                    }};
+
+                    struct P_names : Builtin<P_names> {{
+                        P_names() : Builtin("names") {{ }}
+                        void operator()(VM vm, Out result);
+                    }};
+                }};
         """.format(modname))
-        yield
-        self.write("};")    # }
 
     def write_function(self, ozfunc):
         self.write("""
@@ -45,21 +74,434 @@ class ModuleHeaderWriter(Writer):
         """.format(ozfunc.oz_function_name, ozfunc.get_arg_proto()))
 
 
+_WORKER_POOL_INCLUDES = ['<boostenv.hh>', '<algorithm>', '<atomic>', '<thread>', '<deque>', '<condition_variable>',
+                         '<functional>', '<unordered_set>']
+
+_WORKER_POOL_CODE = """
+    // A fixed pool of native threads running the offloaded (Async) builtins.
+    // The result is bound to the dataflow variable from a VM event, so the
+    // other Oz threads keep running while the C function executes. The calls
+    // sharing a handle run one at a time, in the order they were made, and the
+    // synchronous builtins wait with waitIdle() until no call queued or running
+    // uses their handles.
+    //
+    // The environment only terminates the VM once the feedback nodes of its
+    // calls are released, i.e. once their completion events have run. The
+    // pool is destroyed at exit, after the VM: the queued calls are dropped
+    // then, and the running ones no longer post their completion events.
+    class WorkerPool {
+    public:
+        typedef std::vector<const void*> Handles;
+
+        static WorkerPool& instance() {
+            static WorkerPool pool;
+            return pool;
+        }
+
+        template <typename Work, typename Done>
+        static void offload(VM vm, UnstableNode& result, Handles handles, Work work, Done done) {
+            auto& env = ::mozart::boostenv::BoostBasedVM::forVM(vm);
+            auto feedback = env.createAsyncIOFeedbackNode(result);
+            instance().post(std::move(handles), work, [&env, vm, feedback, done]() {
+                env.postVMEvent([&env, vm, feedback, done]() {
+                    auto value = done(vm);
+                    DataflowVariable(*feedback).bind(vm, value);
+                    env.releaseAsyncIONode(feedback);
+                });
+            });
+        }
+
+        // Wait until no offloaded call, queued or running, uses any of the
+        // handles. This is a single atomic load while nothing is offloaded.
+        static void waitIdle(const Handles& handles) {
+            if (pending().load(std::memory_order_acquire) != 0) {
+                instance().wait(handles);
+            }
+        }
+
+        ~WorkerPool() {
+            {
+                std::lock_guard<std::mutex> lock (_mutex);
+                _stopping = true;
+                _tasks.clear();
+            }
+            _condition.notify_all();
+            for (auto& thread : _threads) {
+                thread.join();
+            }
+        }
+
+    private:
+        struct Task {
+            Handles handles;
+            std::function<void()> work;
+            std::function<void()> notify;
+        };
+
+        // The number of calls offloaded and not yet run.
+        static std::atomic<size_t>& pending() {
+            static std::atomic<size_t> count (0);
+            return count;
+        }
+
+        WorkerPool() : _stopping(false) {
+            auto count = std::max(std::thread::hardware_concurrency(), 1u);
+            for (unsigned i = 0; i < count; ++ i) {
+                _threads.emplace_back([this]() { run(); });
+            }
+        }
+
+        void post(Handles handles, std::function<void()> work, std::function<void()> notify) {
+            {
+                std::lock_guard<std::mutex> lock (_mutex);
+                pending().fetch_add(1, std::memory_order_relaxed);
+                _tasks.push_back(Task {std::move(handles), std::move(work), std::move(notify)});
+            }
+            _condition.notify_one();
+        }
+
+        bool uses(const Handles& handles) {
+            auto used = [&handles](const void* h) {
+                return std::find(handles.begin(), handles.end(), h) != handles.end();
+            };
+            if (std::any_of(_busy.begin(), _busy.end(), used)) {
+                return true;
+            }
+            return std::any_of(_tasks.begin(), _tasks.end(), [&used](const Task& task) {
+                return std::any_of(task.handles.begin(), task.handles.end(), used);
+            });
+        }
+
+        void wait(const Handles& handles) {
+            std::unique_lock<std::mutex> lock (_mutex);
+            while (uses(handles)) {
+                _condition.wait(lock);
+            }
+        }
+
+        // Take the first task none of whose handles is used by a running
+        // task or by an earlier queued task.
+        bool takeRunnable(Task& task) {
+            std::unordered_set<const void*> blocked (_busy);
+            for (auto it = _tasks.begin(); it != _tasks.end(); ++ it) {
+                bool runnable = std::none_of(it->handles.begin(), it->handles.end(),
+                                             [&blocked](const void* h) { return blocked.count(h) != 0; });
+                if (runnable) {
+                    task = std::move(*it);
+                    _tasks.erase(it);
+                    _busy.insert(task.handles.begin(), task.handles.end());
+                    return true;
+                }
+                blocked.insert(it->handles.begin(), it->handles.end());
+            }
+            return false;
+        }
+
+        void run() {
+            while (true) {
+                Task task;
+                {
+                    std::unique_lock<std::mutex> lock (_mutex);
+                    while (!takeRunnable(task)) {
+                        if (_stopping) {
+                            return;
+                        }
+                        _condition.wait(lock);
+                    }
+                }
+
+                task.work();
+
+                {
+                    std::lock_guard<std::mutex> lock (_mutex);
+                    for (auto handle : task.handles) {
+                        _busy.erase(handle);
+                    }
+                    pending().fetch_sub(1, std::memory_order_release);
+                    if (!_stopping) {
+                        task.notify();
+                    }
+                }
+                _condition.notify_all();
+            }
+        }
+
+        std::mutex _mutex;
+        std::condition_variable _condition;
+        std::deque<Task> _tasks;
+        std::unordered_set<const void*> _busy;
+        std::vector<std::thread> _threads;
+        bool _stopping;
+    };
+"""
+
+
+_PROBE_INCLUDES = ['<atomic>', '<chrono>', '<cstring>', '<mutex>', '<vector>']
+
+_PROBE_CODE = """
+    // Counters of the calls, the native time and the VM memory allocated by
+    // each builtin. They are only compiled in if M2G3_ENABLE_PROBES is defined;
+    // otherwise the stats builtin of each module returns the empty record
+    // stats(), i.e. the atom stats, as it does when no builtin was called. The
+    // counters are atomic, since the builtins may run on several threads.
+    #ifdef M2G3_ENABLE_PROBES
+    class ProbeCounters {
+    public:
+        ProbeCounters(const char* module, const nchar* name)
+            : calls(0), nanoseconds(0), bytes(0), _module(module), _name(name)
+        {
+            std::lock_guard<std::mutex> lock (mutex());
+            _next = head();
+            head() = this;
+        }
+
+        static UnstableNode collect(VM vm, const char* module) {
+            std::vector<UnstableField> fields;
+            {
+                std::lock_guard<std::mutex> lock (mutex());
+                for (auto counters = head(); counters != nullptr; counters = counters->_next) {
+                    if (std::strcmp(counters->_module, module) == 0) {
+                        fields.emplace_back();
+                        fields.back().feature = Atom::build(vm, counters->_name);
+                        fields.back().value = buildRecord(vm,
+                            buildArity(vm, MOZART_STR("probe"),
+                                       MOZART_STR("bytes"), MOZART_STR("calls"), MOZART_STR("nanoseconds")),
+                            counters->bytes.exchange(0, std::memory_order_relaxed),
+                            counters->calls.exchange(0, std::memory_order_relaxed),
+                            counters->nanoseconds.exchange(0, std::memory_order_relaxed)
+                        );
+                    }
+                }
+            }
+
+            auto label = Atom::build(vm, MOZART_STR("stats"));
+            if (fields.empty()) {
+                return label;
+            }
+            return buildRecordDynamic(vm, label, fields.size(), fields.data());
+        }
+
+        std::atomic<size_t> calls;
+        std::atomic<size_t> nanoseconds;
+        std::atomic<size_t> bytes;
+
+    private:
+        static ProbeCounters*& head() {
+            static ProbeCounters* list = nullptr;
+            return list;
+        }
+
+        static std::mutex& mutex() {
+            static std::mutex m;
+            return m;
+        }
+
+        const char* _module;
+        const nchar* _name;
+        ProbeCounters* _next;
+    };
+
+    class Probe {
+    public:
+        Probe(VM vm, ProbeCounters& counters)
+            : _vm(vm), _counters(counters), _start(std::chrono::steady_clock::now()),
+              _allocated(vm->getMemoryManager().getAllocated()) {}
+
+        ~Probe() {
+            auto elapsed = std::chrono::steady_clock::now() - _start;
+            _counters.calls.fetch_add(1, std::memory_order_relaxed);
+            _counters.nanoseconds.fetch_add(
+                std::chrono::duration_cast<std::chrono::nanoseconds>(elapsed).count(), std::memory_order_relaxed);
+            auto allocated = _vm->getMemoryManager().getAllocated();
+            if (allocated > _allocated) {
+                _counters.bytes.fetch_add(allocated - _allocated, std::memory_order_relaxed);
+            }
+        }
+
+    private:
+        VM _vm;
+        ProbeCounters& _counters;
+        std::chrono::steady_clock::time_point _start;
+        size_t _allocated;
+    };
+
+    #define M2G3_PROBE(vm, module, name) \\
+        static ProbeCounters _x_probe_counters (module, MOZART_STR(name)); \\
+        Probe _x_probe (vm, _x_probe_counters)
+    #else
+    struct ProbeCounters {
+        static UnstableNode collect(VM vm, const char* module) {
+            return Atom::build(vm, MOZART_STR("stats"));
+        }
+    };
+
+    #define M2G3_PROBE(vm, module, name)
+    #endif
+"""
+
+
+_TRACE_INCLUDES = ['<cstdint>', '<cstdio>', '<cstdlib>', '<cstring>', '<mutex>', '<string>',
+                   '<type_traits>', '<vector>']
+
+_TRACE_CODE = """
+    // The trace of the calls of the traced builtins, which the generated
+    // -replay tool runs again against the library. It is only written if the
+    // M2G3_TRACE environment variable is set, to the file named by its value
+    // followed by the library name and ".trace". Each record is the opcode of
+    // the C function followed by its arguments and result: numbers and enums
+    // as their native bytes, strings as a 32-bit length and the characters,
+    // and handles as their 64-bit address. The records are buffered and
+    // written in chunks.
+    namespace {
+        class Trace {
+        public:
+            template <typename... Values>
+            static void record(uint32_t opcode, const Values&... values) {
+                auto& trace = instance();
+                if (trace._file == nullptr) {
+                    return;
+                }
+
+                std::lock_guard<std::mutex> lock (trace._mutex);
+                trace.put(opcode);
+                int written[] = {0, (trace.put(values), 0)...};
+                (void) written;
+                if (trace._buffer.size() >= chunkSize) {
+                    trace.flush();
+                }
+            }
+
+            ~Trace() {
+                if (_file != nullptr) {
+                    flush();
+                    std::fclose(_file);
+                }
+            }
+
+        private:
+            enum : size_t { chunkSize = 1 << 16 };
+
+            Trace() : _file(nullptr) {
+                auto prefix = std::getenv("M2G3_TRACE");
+                if (prefix != nullptr) {
+                    auto filename = std::string(prefix) + traceName + ".trace";
+                    _file = std::fopen(filename.c_str(), "wb");
+                }
+                if (_file != nullptr) {
+                    std::fwrite("M2G3TRC1", 1, 8, _file);
+                    _buffer.reserve(chunkSize);
+                }
+            }
+
+            static Trace& instance() {
+                static Trace trace;
+                return trace;
+            }
+
+            template <typename T>
+            typename std::enable_if<std::is_arithmetic<T>::value || std::is_enum<T>::value>::type
+            put(const T& value) {
+                auto bytes = reinterpret_cast<const char*>(&value);
+                _buffer.insert(_buffer.end(), bytes, bytes + sizeof(T));
+            }
+
+            void put(const char* value) {
+                uint32_t length = value == nullptr ? UINT32_MAX : std::strlen(value);
+                put(length);
+                if (value != nullptr) {
+                    _buffer.insert(_buffer.end(), value, value + length);
+                }
+            }
+
+            template <typename T>
+            void put(T* value) {
+                put(static_cast<uint64_t>(reinterpret_cast<uintptr_t>(value)));
+            }
+
+            void flush() {
+                std::fwrite(_buffer.data(), 1, _buffer.size(), _file);
+                _buffer.clear();
+            }
+
+            std::FILE* _file;
+            std::mutex _mutex;
+            std::vector<char> _buffer;
+        };
+    }
+"""
+
+
+def module_includes(constants, lazy=False, probes=False, trace=False):
+    """
+    List the headers included by the module implementation, besides the
+    generated headers, for the options of `ModuleWriter`.
+    """
+    headers = list(constants.SUPPORT_INCLUDES)
+    if constants.OFFLOADABLE:
+        headers.extend(_WORKER_POOL_INCLUDES)
+    if lazy:
+        headers.extend(['<algorithm>', '<iterator>'])
+    if probes:
+        headers.extend(_PROBE_INCLUDES)
+    if trace:
+        headers.extend(_TRACE_INCLUDES)
+    return headers
+
+
 class ModuleWriter(Writer):
-    def __init__(self, basename):
+    def __init__(self, basename, constants, lazy=False, probes=False, trace=False):
+        """
+        Create the writer of the module implementation. If *lazy* is true, the
+        builtins are defined in the ``L_<mod>`` structs, and `write_lookup`
+        writes the table of the lazily created builtins. If *probes* is true,
+        each builtin starts with a probe (see `_PROBE_CODE`). If *trace* is
+        true, the ``Trace`` recorder used by the traced builtins is defined
+        (see `_TRACE_CODE`).
+        """
         super().__init__(join(SRC, basename + CC_EXT))
         self._basename = basename
+        self._constants = constants
+        self._lazy = lazy
+        self._probes = probes
+        self._trace = trace
 
     def write_prolog(self):
         self.write("""
             #include "{bn}{hh}"
             #include "{bn}{bd}"
             #include "{bn}{ty}"
+        """.format(bn=self._basename, hh=HH_EXT, bd=BUILDERS_HH_EXT, ty=TYPES_HH_EXT))
 
-            namespace m2g3 {{
+        for header in module_includes(self._constants, self._lazy, self._probes, self._trace):
+            self.write('#include ' + header)
+
+        self.write("""
+            namespace m2g3 {
                 using namespace ::mozart;
                 using namespace ::mozart::builtins;
-        """.format(bn=self._basename, hh=HH_EXT, bd=BUILDERS_HH_EXT, ty=TYPES_HH_EXT))
+        """)
+
+        if self._constants.OFFLOADABLE:
+            self.write(_WORKER_POOL_CODE)
+
+        if self._probes:
+            self.write(_PROBE_CODE)
+
+        if self._trace:
+            self.write('static const char traceName[] = "{0}";'.format(self._basename))
+            self.write(_TRACE_CODE)
+
+        if self._lazy:
+            self.write("""
+                template <typename T>
+                static BaseBuiltin& lazyBuiltin() {
+                    static T builtin;
+                    return builtin;
+                }
+            """)
+
+        for code in self._constants.SUPPORT_CODE:
+            self.write(code)
 
     def write_epilog(self):
         self.write("""
@@ -67,10 +509,63 @@ class ModuleWriter(Writer):
             }}
         """.format(bn=self._basename, out=OUT_EXT, bicc=BUILTINS_CC_EXT))
 
-    def write_function(self, modname, ozfunc):
+    def write_function(self, modname, ozfunc, probe=True):
+        """
+        Write the definition of a builtin. The *probe* is only written if the
+        probes are enabled.
+        """
         self.write("""
-                void M_{0}::P_{1}::operator()(VM vm{2}) {{
-        """.format(modname, ozfunc.oz_function_name, ozfunc.get_arg_proto()))
+                void {0}_{1}::P_{2}::operator()(VM vm{3}) {{
+        """.format('L' if self._lazy else 'M', modname, ozfunc.oz_function_name, ozfunc.get_arg_proto()))
+        if self._probes and probe:
+            self.write('M2G3_PROBE(vm, "{0}", "{1}");'.format(modname, ozfunc.oz_function_name))
         ozfunc.write_to(self)
         self.write("}") # }
 
+    def write_lookup(self, modname, ozfunc_names):
+        """
+        Write the lookup table of a lazy module. The table is a sorted static
+        array, so it needs no initialization at startup, and each builtin is
+        only constructed when it is looked up the first time.
+        """
+        self.write("""
+            namespace {{
+                struct LazyBuiltin_{0} {{
+                    const nchar* name;
+                    BaseBuiltin& (*get)();
+                }};
+
+                const LazyBuiltin_{0} lazyBuiltins_{0}[] = {{
+        """.format(modname))
+
+        for name in sorted(set(ozfunc_names)):
+            self.write("""
+                {{MOZART_STR("{1}"), &lazyBuiltin<L_{0}::P_{1}>}},
+            """.format(modname, name))
+
+        self.write("""
+                }};
+            }}
+
+            void M_{0}::P_lookup::operator()(VM vm, In name, Out result) {{
+                auto str = vsToString<nchar>(vm, name);
+                auto begin = std::begin(lazyBuiltins_{0});
+                auto end = std::end(lazyBuiltins_{0});
+                auto it = std::lower_bound(begin, end, str, [](const LazyBuiltin_{0}& entry, const std::basic_string<nchar>& key) {{
+                    return entry.name < key;
+                }});
+                if (it == end || it->name != str) {{
+                    raiseTypeError(vm, MOZART_STR("builtin name of {0}"), name);
+                }}
+                result = BuiltinProcedure::build(vm, it->get());
+            }}
+
+            void M_{0}::P_names::operator()(VM vm, Out result) {{
+                OzListBuilder builder (vm);
+                for (auto& entry : lazyBuiltins_{0}) {{
+                    builder.push_back(vm, entry.name);
+                }}
+                result = builder.get(vm);
+            }}
+        """.format(modname))
+
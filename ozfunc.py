@@ -4,7 +4,7 @@ from common import *
 from fixers import fixup_args
 from fake_type import PointerOf
 from to_cc import to_cc
-from arguments import In, Out
+from arguments import In, Out, InOut, BooleanIn, BooleanOut, Constant, StaticStringOut
 
 def _decode_argument(args_dict, arg_name, default, typ, constants):
     arg_tuple = None
@@ -44,15 +44,124 @@ def _get_arguments(func_cursor, c_func_name, constants):
 
     return_type = func_cursor.result_type.get_canonical()
     if return_type.kind != TypeKind.VOID:
-        yield _decode_argument(args_dict, 'return', Out, PointerOf(return_type), constants)
+        default = Out
+        if is_c_string(return_type) and any(regex.match(c_func_name) for regex in constants.STATIC_STRING_RETURNS):
+            default = StaticStringOut
+        yield _decode_argument(args_dict, 'return', default, PointerOf(return_type), constants)
 
 
 
+def _is_generic_shape(function, args):
+    """
+    Check whether a function can be bound by the ``GenericBuiltin`` template,
+    i.e. all of its arguments are plain inputs, and it returns nothing or a
+    plain output.
+    """
+    func_type = function.type
+    if func_type.kind != TypeKind.FUNCTIONPROTO or func_type.is_function_variadic():
+        return False
+
+    for arg in args:
+        if arg._name == 'return':
+            if type(arg) is not Out:
+                return False
+        elif type(arg) is not In or arg._type.get_canonical().kind == TypeKind.CONSTANTARRAY:
+            return False
+
+    return True
+
+
+def _is_traceable_type(typ):
+    """
+    Check whether values of a clang Type can be written to the call trace, i.e.
+    it is a number, an enum, a C string or a handle (a pointer to a struct whose
+    definition is hidden).
+    """
+    canonical = typ.get_canonical()
+    return (is_primitive_type(canonical) or canonical.kind == TypeKind.ENUM or
+            is_c_string(canonical) or _is_handle_type(canonical))
+
+
+def _is_handle_type(canonical):
+    if canonical.kind != TypeKind.POINTER:
+        return False
+    pointee = canonical.get_pointee().get_canonical()
+    return pointee.kind == TypeKind.RECORD and not pointee.get_declaration().is_definition()
+
+
+def _offload_handles(args, constants):
+    """
+    Get the C expressions of the handles an offloaded call with these
+    arguments uses: the input handles of the PIN_FUNCTIONS types, and the
+    handles reached through them (see ``OFFLOAD_RELATED_HANDLES``). Returns an
+    empty list if nothing is offloaded.
+    """
+    if not constants.OFFLOADABLE:
+        return []
+
+    handles = []
+    for arg in args:
+        if arg._name == 'return' or type(arg) is not In:
+            continue
+        type_name = to_cc(arg._type)
+        if type_name in constants.PIN_FUNCTIONS:
+            handles.append(arg.cc_name)
+            handles.extend(getter + '(' + arg.cc_name + ')'
+                           for getter in constants.OFFLOAD_RELATED_HANDLES.get(type_name, []))
+    return handles
+
+
+def _describe_type(typ, flags):
+    """
+    Classify a clang Type for the argument metadata. Returns a ``(kind,
+    detail)`` pair, where the kind is one of ``'bool'``, ``'int'``,
+    ``'float'``, ``'string'``, ``'flags'``, ``'enum'`` (the detail is the atom
+    of the first enumerator), ``'handle'`` or ``'other'`` (the detail is the C
+    type).
+    """
+    canonical = typ.get_canonical()
+    kind = canonical.kind
+    if kind == TypeKind.BOOL:
+        return ('bool', None)
+    elif kind in INTEGER_KINDS:
+        return ('int', None)
+    elif kind in FLOAT_KINDS:
+        return ('float', None)
+    elif is_c_string(canonical):
+        return ('string', None)
+    elif kind == TypeKind.ENUM:
+        enum_decl = canonical.get_declaration()
+        if any(regex.match(name_of(enum_decl)) for regex in flags):
+            return ('flags', None)
+        atom_names = list(strip_common_prefix_and_camelize(map(name_of, enum_decl.get_children())))
+        return ('enum', atom_names[0] if atom_names else None)
+    elif _is_handle_type(canonical):
+        return ('handle', to_cc(typ))
+    else:
+        return ('other', to_cc(typ))
+
+
 class OzFunction:
-    def __init__(self, function, oz_function_name, constants):
+    def __init__(self, function, oz_function_name, constants, generic=False, trace=False):
+        """
+        Create the builtin of a C function. If *generic* is true and the
+        function has a simple shape, the body just instantiates the
+        ``GenericBuiltin`` template with the function pointer, instead of
+        unbuilding and building each argument inline.
+
+        If *trace* is true and the function has a simple shape whose arguments
+        can all be traced, the builtin records the call (see ``Trace`` in the
+        module code), and `traced` is set. Traced functions are never bound
+        through the generic wrapper, since the record needs the unbuilt values.
+
+        If the module offloads functions, a builtin taking handles waits until
+        no offloaded call uses them (see ``WorkerPool::waitIdle``), so it is
+        not bound through the generic wrapper either.
+        """
         c_func_name = name_of(function)
         self._source_function_name = c_func_name
         self.oz_function_name = oz_function_name
+        self.traced = False
 
         try:
             (arg_proto, func_def) = constants.SPECIAL_FUNCTIONS[c_func_name]
@@ -69,10 +178,20 @@ class OzFunction:
             self._arg_proto = None
             self._func_def = None
 
+            self._call_name = find_from_regex_map(constants.FUNCTION_CALL_REPLACEMENTS, c_func_name, c_func_name)
             self._pre_setup = find_from_regex_map(constants.FUNCTION_PRE_SETUP, c_func_name, '')
             self._post_setup = find_from_regex_map(constants.FUNCTION_POST_SETUP, c_func_name, '')
             self._pre_teardown = find_from_regex_map(constants.FUNCTION_PRE_TEARDOWN, c_func_name, '')
             self._post_teardown = find_from_regex_map(constants.FUNCTION_POST_TEARDOWN, c_func_name, '')
+            self._flags = constants.FLAGS
+            self._handles = _offload_handles(self._args, constants)
+            is_simple = (_is_generic_shape(function, self._args) and
+                         not any((self._pre_setup, self._post_setup,
+                                  self._pre_teardown, self._post_teardown)))
+            self.traced = (trace and is_simple and
+                           all(_is_traceable_type(a._type.get_pointee() if a._name == 'return' else a._type)
+                               for a in self._args))
+            self._generic = generic and is_simple and not self.traced and not self._handles
 
     def get_arg_proto(self):
         if self._arg_proto is None:
@@ -89,25 +208,66 @@ class OzFunction:
 
         return self._arg_proto
 
+    def get_oz_arguments(self):
+        """
+        Describe the Oz arguments of the builtin, in the order of the argument
+        prototype, as ``(inout, kind, detail)`` triples, where *inout* is
+        ``'In'`` or ``'Out'`` and the kind and detail are as in
+        `_describe_type`. Arguments with custom conversions are of kind
+        ``'other'``. Returns None for the special functions.
+        """
+        if self._func_def is not None:
+            return None
+
+        content = []
+        for arg in self._args:
+            inout = arg.get_oz_inout()
+            if inout is None:
+                continue
+            if isinstance(arg, (BooleanIn, BooleanOut)):
+                description = ('bool', None)
+            elif type(arg) in {In, Out, InOut, StaticStringOut}:
+                typ = arg._type if inout == 'In' else arg._type.get_pointee()
+                description = _describe_type(typ, self._flags)
+            else:
+                description = ('other', type(arg).__name__)
+            if inout in {'In', 'InOut'}:
+                content.append(('In',) + description)
+            if inout in {'Out', 'InOut'}:
+                content.append(('Out',) + description)
+        return tuple(content)
+
     def write_to(self, target):
         if self._func_def is not None:
             target.write(self._func_def)
             return
 
+        if self._generic:
+            self._write_generic_to(target)
+            return
+
         target.write(self._pre_setup)
 
         for arg in self._args:
             arg._with_declaration = True
             arg.pre(target)
 
+        if self._handles:
+            target.write('WorkerPool::waitIdle({' + ', '.join(self._handles) + '});')
+
         target.write(self._post_setup)
 
         call_args = (a.cc_name for a in self._args if a._name != 'return')
-        call_statement = self._source_function_name + '(' + ', '.join(call_args) + ');'
+        call_statement = self._call_name + '(' + ', '.join(call_args) + ');'
         if any(a._name == 'return' for a in self._args):
             call_statement = '*' + CC_NAME_OF_RETURN + ' = ' + call_statement
         target.write(call_statement)
 
+        if self.traced:
+            trace_args = ['0x{0:08x}u'.format(trace_opcode_of(self._source_function_name))]
+            trace_args.extend(a.cc_name if a._name != 'return' else '*' + a.cc_name for a in self._args)
+            target.write('Trace::record(' + ', '.join(trace_args) + ');')
+
         target.write(self._pre_teardown)
 
         for arg in self._args:
@@ -116,3 +276,131 @@ class OzFunction:
 
         target.write(self._post_teardown)
 
+    def _write_generic_to(self, target):
+        call_args = ['vm']
+        call_args.extend(a.oz_in_name for a in self._args if a._name != 'return')
+        call_statement = 'GenericBuiltin<decltype(&{0}), &{0}>::call({1});'.format(
+            self._call_name, ', '.join(call_args))
+        for arg in self._args:
+            if arg._name == 'return':
+                call_statement = arg.oz_out_name + ' = ' + call_statement
+        target.write(call_statement)
+
+
+
+class ExtraFunction:
+    """
+    A builtin which is not backed by any C function. These are listed in the
+    ``EXTRA_FUNCTIONS`` of the constants module, as a dictionary of Oz module
+    name to a dictionary of Oz function name to ``(arg_proto, func_def)``.
+    """
+
+    def __init__(self, oz_function_name, arg_proto, func_def):
+        self.oz_function_name = oz_function_name
+        self._arg_proto = arg_proto
+        self._func_def = func_def
+
+    def get_arg_proto(self):
+        return self._arg_proto
+
+    def get_oz_arguments(self):
+        return None
+
+    def write_to(self, target):
+        target.write(self._func_def)
+
+
+class AsyncOzFunction:
+    """
+    The asynchronous variant of an offloadable function. The arguments are
+    unbuilt on the VM thread, the C function is called on the worker pool, and
+    its result is bound to the dataflow variable returned by the builtin. The
+    handles passed to the function are pinned (referenced) until it completes.
+    The calls sharing a handle, or a handle reached through one (e.g. the
+    target of a context), are serialized by the worker pool, and the
+    synchronous builtins wait for them.
+    """
+
+    def __init__(self, ozfunc, constants):
+        c_func_name = ozfunc._source_function_name
+        if ozfunc._func_def is not None or any((ozfunc._pre_setup, ozfunc._post_setup,
+                                                ozfunc._pre_teardown, ozfunc._post_teardown)):
+            raise ValueError(c_func_name + ' cannot be offloaded: it has custom code')
+
+        for arg in ozfunc._args:
+            allowed = {Out, BooleanOut} if arg._name == 'return' else {In, BooleanIn, Constant}
+            if type(arg) not in allowed:
+                raise ValueError(c_func_name + ' cannot be offloaded: argument ' +
+                                 arg._name + ' is ' + type(arg).__name__)
+
+        self.oz_function_name = ozfunc.oz_function_name + 'Async'
+        self._ozfunc = ozfunc
+        self._pin_functions = constants.PIN_FUNCTIONS
+        self._handles = _offload_handles(ozfunc._args, constants)
+
+    def get_arg_proto(self):
+        content = []
+        for arg in self._ozfunc._args:
+            if arg.get_oz_inout() == 'In':
+                content.append(', In ')
+                content.append(arg.oz_in_name)
+        content.append(', Out ')
+        content.append(oz_out_name_of('result'))
+        return ''.join(content)
+
+    def get_oz_arguments(self):
+        return None
+
+    def write_to(self, target):
+        call_args = []
+        pins = []
+        return_arg = None
+
+        for arg in self._ozfunc._args:
+            if arg._name == 'return':
+                return_arg = arg
+                continue
+
+            arg._with_declaration = True
+            arg.pre(target)
+
+            cc_name = arg.cc_name
+            if is_c_string(arg._type):
+                # the unbuilt string lives in the VM heap, which may be
+                # collected while the worker runs.
+                copy_name = unique_str()
+                target.write('std::string {0} ({1});'.format(copy_name, cc_name))
+                cc_name = copy_name + '.c_str()'
+            call_args.append(cc_name)
+
+            pin = self._pin_functions.get(to_cc(arg._type))
+            if pin is not None:
+                pins.append((pin, arg.cc_name))
+
+        for (reference, _), cc_name in pins:
+            target.write(reference + '(' + cc_name + ');')
+
+        call_statement = self._ozfunc._call_name + '(' + ', '.join(call_args) + ');'
+        if return_arg is not None:
+            target.write('auto {0} = std::make_shared<{1}>();'.format(
+                return_arg.cc_name, to_cc(return_arg._type.get_pointee())))
+            call_statement = '*' + return_arg.cc_name + ' = ' + call_statement
+
+        # the calls on the same handles are run in order, one at a time.
+        target.write("""
+            WorkerPool::offload(vm, {0}, {{{1}}}, [=]() {{
+                {2}
+            }}, [=](VM vm) -> UnstableNode {{
+        """.format(oz_out_name_of('result'), ', '.join(self._handles), call_statement))
+
+        for (_, release), cc_name in pins:
+            target.write(release + '(' + cc_name + ');')
+
+        if return_arg is not None:
+            return_arg._with_declaration = True
+            return_arg.post(target)
+            target.write('return ' + return_arg.oz_out_name + ';')
+        else:
+            target.write('return ::mozart::build(vm, ::mozart::unit);')
+
+        target.write('});')
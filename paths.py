@@ -0,0 +1,24 @@
+# The names of the generated files and directories. This module does not depend
+# on libclang, so that the constants modules may import it (see pkg_config.py).
+
+C_FILES = 'c-files'
+C_EXT = '.c'
+SRC = 'src'
+CC_EXT = '.cc'
+HH_EXT = '.hh'
+OUT_EXT = '.out'
+
+SHARED_BASENAME = 'shared'
+
+TYPES_HH_EXT = '-types.hh'
+TYPES_DECL_HH_EXT = '-types-decl.hh'
+MODULES_HH_EXT = '-modules.hh'
+BUILDERS_HH_EXT = '-builders.hh'
+BUILDERS_CC_EXT = '-builders.cc'
+BUILTINS_HH_EXT = 'builtins.hh'
+BUILTINS_CC_EXT = 'builtins.cc'
+REPLAY_CC_EXT = '-replay.cc'
+BENCH_OZ_EXT = '_bench.oz'
+DEPFILE_EXT = '.d'
+PCH_HH_EXT = '-pch.hh'
+FUNCTION_CACHE_NAME = 'functions.cache'
@@ -0,0 +1,49 @@
+from os.path import join
+from writer import Writer
+from common import *
+
+
+class PrecompiledHeaderWriter(Writer):
+    def __init__(self, basename, headers, includes):
+        """
+        Create the writer of the umbrella header, which includes the C files of
+        the *headers* modules, the Mozart and boostenv headers and the other
+        *includes*, i.e. everything the generated code uses which does not
+        change when the bindings are regenerated. The build precompiles it and
+        force-includes it in every object (see the Makefile).
+
+        The file is only replaced when its content changes, so regenerating the
+        bindings does not invalidate the precompiled header.
+        """
+        super().__init__(join(SRC, basename + PCH_HH_EXT), streaming=False)
+        self._headers = headers
+        self._includes = includes
+
+    def __exit__(self, p, q, r):
+        if p is not None:
+            return False
+        self.write_epilog()
+        content = ''.join(self._writer.lines)
+        try:
+            with open(self._filename) as f:
+                if f.read() == content:
+                    return False
+        except OSError:
+            pass
+        with open(self._filename, 'w') as f:
+            f.write(content)
+        return False
+
+    def write_prolog(self):
+        super().write_prolog()
+        for header in self._headers:
+            self.write('#include "../' + C_FILES + '/' + header + C_EXT + '"')
+        written = set()
+        for header in ['<mozart.hh>', '<boostenv.hh>'] + self._includes:
+            if header not in written:
+                written.add(header)
+                self.write('#include ' + header)
+
+    def write_epilog(self):
+        super().write_epilog()
+
@@ -1,12 +1,82 @@
+import json
+from os import environ, makedirs, replace, scandir, stat
+from os.path import join
 from subprocess import check_output
+from paths import SRC
+
+PKG_CONFIG_CACHE = join(SRC, 'pkg-config.cache')
+
+# ^ the variables changing where pkg-config looks for the .pc files, and so its
+#   results.
+_ENVIRONMENT = ['PKG_CONFIG_PATH', 'PKG_CONFIG_LIBDIR', 'PKG_CONFIG_SYSROOT_DIR']
+
+def _load_cache():
+    try:
+        with open(PKG_CONFIG_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def _save_cache(cache):
+    temp_filename = PKG_CONFIG_CACHE + '.tmp'
+    try:
+        makedirs(SRC, exist_ok=True)
+        with open(temp_filename, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        replace(temp_filename, PKG_CONFIG_CACHE)
+    except OSError:
+        pass
+
+def _search_path():
+    """
+    Get the directories where pkg-config looks for the .pc files.
+    """
+    path = environ.get('PKG_CONFIG_PATH', '').split(':')
+    if 'PKG_CONFIG_LIBDIR' in environ:
+        path.extend(environ['PKG_CONFIG_LIBDIR'].split(':'))
+    else:
+        default = check_output(['pkg-config', '--variable', 'pc_path', 'pkg-config'], universal_newlines=True)
+        path.extend(default.strip().split(':'))
+    return [d for d in path if d]
+
+def _stamp(search_path):
+    """
+    Stamp the .pc files of the search path with their modification times (and
+    those of their directories, which change when a file is added or removed),
+    so that installing, upgrading or removing a package changes the stamp.
+    """
+    stamp = []
+    for directory in search_path:
+        try:
+            stamp.append(stat(directory).st_mtime_ns)
+            with scandir(directory) as entries:
+                stamp.append(max((entry.stat().st_mtime_ns for entry in entries
+                                  if entry.name.endswith('.pc')), default=0))
+        except OSError:
+            stamp.append(None)
+    return stamp
+
 
 def pkg_config(packages):
     """
-    Return the result of `pkg-config --cflags packages`.
+    Return the result of `pkg-config --cflags packages`. The results are
+    cached in ``src/pkg-config.cache``, keyed on the packages and the
+    ``PKG_CONFIG_*`` variables, so pkg-config is only run again when one of
+    them changes, or when a .pc file of the search path is changed, added or
+    removed.
     """
 
+    key = json.dumps([packages] + [environ.get(name) for name in _ENVIRONMENT])
+    cache = _load_cache()
+    entry = cache.get(key)
+    if isinstance(entry, dict) and _stamp(entry.get('path', [])) == entry.get('stamp'):
+        return entry['cflags']
+
+    search_path = _search_path()
     args = ['pkg-config', '--cflags']
     args.extend(packages)
-    return check_output(args, universal_newlines=True).split()
-
-
+    result = check_output(args, universal_newlines=True).split()
+    cache[key] = {'path': search_path, 'stamp': _stamp(search_path), 'cflags': result}
+    _save_cache(cache)
+    return result
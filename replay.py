@@ -0,0 +1,247 @@
+from os.path import join
+from writer import Writer
+from common import *
+
+_REPLAY_INCLUDES = ['<chrono>', '<cstdint>', '<cstdio>', '<cstdlib>', '<cstring>', '<deque>', '<string>',
+                    '<tuple>', '<type_traits>', '<unordered_map>']
+
+_REPLAY_CODE = """
+    namespace {
+        // Reads the records of a trace written by the Trace class of the
+        // module. The handles recorded as results are mapped to the objects
+        // created during the replay, so the later calls get the new objects.
+        class TraceReader {
+        public:
+            explicit TraceReader(std::FILE* file) : _file(file), _missing(false) {}
+
+            bool readOpcode(uint32_t& opcode) {
+                _strings.clear();
+                return std::fread(&opcode, sizeof(opcode), 1, _file) == 1;
+            }
+
+            template <typename T>
+            typename std::enable_if<std::is_arithmetic<T>::value || std::is_enum<T>::value>::type
+            read(T& value) {
+                readBytes(&value, sizeof(T));
+            }
+
+            void read(const char*& value) {
+                uint32_t length;
+                read(length);
+                if (length == UINT32_MAX) {
+                    value = nullptr;
+                    return;
+                }
+                _strings.emplace_back(length, '\\0');
+                readBytes(&_strings.back()[0], length);
+                value = _strings.back().c_str();
+            }
+
+            template <typename T>
+            void read(T*& value) {
+                uint64_t id;
+                read(id);
+                value = nullptr;
+                if (id != 0) {
+                    auto it = _handles.find(id);
+                    if (it == _handles.end()) {
+                        _missing = true;
+                    } else {
+                        value = static_cast<T*>(it->second);
+                    }
+                }
+            }
+
+            template <typename T>
+            void readResult(const T&) {
+                T recorded;
+                read(recorded);
+            }
+
+            void readResult(const char* const&) {
+                const char* recorded;
+                read(recorded);
+            }
+
+            template <typename T>
+            void readResult(T* const& value) {
+                uint64_t id;
+                read(id);
+                if (id != 0 && value != nullptr) {
+                    _handles[id] = const_cast<void*>(static_cast<const void*>(value));
+                }
+            }
+
+            // Whether a handle of the current record was not created during
+            // the replay, in which case the call is skipped.
+            bool missing() {
+                auto missing = _missing;
+                _missing = false;
+                return missing;
+            }
+
+        private:
+            void readBytes(void* data, size_t size) {
+                if (size > 0 && std::fread(data, size, 1, _file) != 1) {
+                    std::fprintf(stderr, "the trace is truncated\\n");
+                    std::exit(1);
+                }
+            }
+
+            std::FILE* _file;
+            bool _missing;
+            std::deque<std::string> _strings;
+            std::unordered_map<uint64_t, void*> _handles;
+        };
+
+        struct Stats {
+            const char* name;
+            uint64_t calls;
+            uint64_t skipped;
+            uint64_t nanoseconds;
+        };
+
+        uint64_t elapsedSince(std::chrono::steady_clock::time_point start) {
+            auto elapsed = std::chrono::steady_clock::now() - start;
+            return std::chrono::duration_cast<std::chrono::nanoseconds>(elapsed).count();
+        }
+
+        template <size_t... indices>
+        struct IndexSequence {};
+
+        template <size_t n, size_t... indices>
+        struct MakeIndexSequence : MakeIndexSequence<n-1, n-1, indices...> {};
+
+        template <size_t... indices>
+        struct MakeIndexSequence<0, indices...> {
+            typedef IndexSequence<indices...> type;
+        };
+
+        template <typename R, typename... Args>
+        struct Replay {
+            template <size_t... indices>
+            static void run(TraceReader& reader, Stats& stats, R (*f)(Args...), IndexSequence<indices...>) {
+                std::tuple<typename std::decay<Args>::type...> args;
+                int unused[] = {0, (reader.read(std::get<indices>(args)), 0)...};
+                (void) unused;
+                if (reader.missing()) {
+                    reader.readResult(R());
+                    stats.skipped += 1;
+                    return;
+                }
+
+                auto start = std::chrono::steady_clock::now();
+                R result = f(std::get<indices>(args)...);
+                stats.nanoseconds += elapsedSince(start);
+                stats.calls += 1;
+                reader.readResult(result);
+            }
+        };
+
+        template <typename... Args>
+        struct Replay<void, Args...> {
+            template <size_t... indices>
+            static void run(TraceReader& reader, Stats& stats, void (*f)(Args...), IndexSequence<indices...>) {
+                std::tuple<typename std::decay<Args>::type...> args;
+                int unused[] = {0, (reader.read(std::get<indices>(args)), 0)...};
+                (void) unused;
+                if (reader.missing()) {
+                    stats.skipped += 1;
+                    return;
+                }
+
+                auto start = std::chrono::steady_clock::now();
+                f(std::get<indices>(args)...);
+                stats.nanoseconds += elapsedSince(start);
+                stats.calls += 1;
+            }
+        };
+
+        template <typename R, typename... Args>
+        void replay(TraceReader& reader, Stats& stats, R (*f)(Args...)) {
+            Replay<R, Args...>::run(reader, stats, f, typename MakeIndexSequence<sizeof...(Args)>::type());
+        }
+    }
+"""
+
+
+class ReplayWriter(Writer):
+    def __init__(self, basename):
+        """
+        Create the writer of the replay tool, a standalone program which runs
+        the calls recorded in a trace (see ``Trace`` in the module code)
+        directly against the library, and prints the number of calls and the
+        time spent in each function. The functions are added by
+        `write_function`; they must be the traced functions of the module.
+        """
+        super().__init__(join(SRC, basename + REPLAY_CC_EXT))
+        self._basename = basename
+        self._functions = {}
+
+    def write_prolog(self):
+        self.write('#include "../' + C_FILES + '/' + self._basename + C_EXT + '"')
+        for header in _REPLAY_INCLUDES:
+            self.write('#include ' + header)
+        self.write(_REPLAY_CODE)
+
+    def write_epilog(self):
+        functions = sorted(self._functions.items())
+
+        self.write('static Stats stats[] = {')  # }
+        for _, c_func_name in functions:
+            self.write('{{"{0}", 0, 0, 0}},'.format(c_func_name))
+        self.write('};')
+
+        self.write("""
+            int main(int argc, char** argv) {
+                if (argc != 2) {
+                    std::fprintf(stderr, "usage: %s <trace file>\\n", argv[0]);
+                    return 2;
+                }
+
+                auto file = std::fopen(argv[1], "rb");
+                char magic[8];
+                if (file == nullptr || std::fread(magic, sizeof(magic), 1, file) != 1 ||
+                        std::memcmp(magic, "M2G3TRC1", sizeof(magic)) != 0) {
+                    std::fprintf(stderr, "%s is not a trace file\\n", argv[1]);
+                    return 1;
+                }
+
+                TraceReader reader (file);
+                uint32_t opcode;
+                while (reader.readOpcode(opcode)) {
+                    switch (opcode) {
+        """)
+
+        for i, (opcode, c_func_name) in enumerate(functions):
+            self.write('case 0x{0:08x}u: replay(reader, stats[{1}], &{2}); break;'.format(opcode, i, c_func_name))
+
+        self.write("""
+                        default:
+                            std::fprintf(stderr, "unknown opcode %08x\\n", opcode);
+                            return 1;
+                    }
+                }
+                std::fclose(file);
+
+                std::printf("function\\tcalls\\tskipped\\tnanoseconds\\n");
+                for (auto& entry : stats) {
+                    if (entry.calls > 0 || entry.skipped > 0) {
+                        std::printf("%s\\t%llu\\t%llu\\t%llu\\n", entry.name,
+                                    static_cast<unsigned long long>(entry.calls),
+                                    static_cast<unsigned long long>(entry.skipped),
+                                    static_cast<unsigned long long>(entry.nanoseconds));
+                    }
+                }
+                return 0;
+            }
+        """)
+
+    def write_function(self, c_func_name):
+        """
+        Add a traced C function to the replay tool.
+        """
+        opcode = trace_opcode_of(c_func_name)
+        other = self._functions.setdefault(opcode, c_func_name)
+        if other != c_func_name:
+            raise ValueError('trace opcodes of ' + other + ' and ' + c_func_name + ' collide')
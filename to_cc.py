@@ -42,7 +42,7 @@ RECORD_KEYWORD = {
 def convert_canonical(typ):
     decl = typ.get_declaration()
     struct_name = decl.displayname.decode('utf-8')
-    if not struct_name:
+    if not struct_name and decl.translation_unit is not None:
         typedef_node = Cursor.from_location(decl.translation_unit, decl.extent.end)
         if typedef_node.kind == CursorKind.TYPEDEF_DECL:
             struct_name = typedef_node.displayname.decode('utf-8')
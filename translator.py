@@ -1,71 +1,130 @@
 #!/usr/bin/env python3
 
+from time import perf_counter
+_load_time = perf_counter()
+
 import re
 import sys
-from os import makedirs
-from os.path import join, basename, splitext
+from os import makedirs, getcwd, sep
+from os.path import join, basename, splitext, dirname, abspath, relpath, isabs
+from argparse import ArgumentParser
 from importlib import import_module
-from collections import OrderedDict
-from clang.cindex import Config, TranslationUnit, CursorKind
+from collections import OrderedDict, Counter
+from itertools import chain
 from common import *
-from builders import BuildersWriter
-from module import ModuleHeaderWriter, ModuleWriter
-from datatype import DataTypeDeclWriter, DataTypeWriter
-from ozfunc import OzFunction
 
-Config.set_compatibility_check(False)
+# ^ the writers, the IR and the function cache are imported by the functions
+#   using them, so that the startup (e.g. --help, or importing this module)
+#   does not pay for them. libclang itself is only loaded by the first parse.
+
+_import_time = perf_counter() - _load_time
 
 #def is_blacklisted(name):
 #    return any(regex.match(name) for regex in BLACKLISTED)
 
 #-------------------------------------------------------------------------------
 
-def collect_nodes(basename, constants):
+def parse(basenames, constants_list, fast=False):
+    """
+    Parse the C files of all modules as a single translation unit.
+
+    In fast mode, function bodies are skipped and an incomplete translation
+    unit is accepted, since only the declarations are harvested.
+    """
+    from clang.cindex import Config, TranslationUnit
+    if not Config.loaded:
+        Config.set_compatibility_check(False)
+
+    clang_args = []
+    for constants in constants_list:
+        for arg in constants.PKG_CONFIG_RES:
+            arg = arg.encode('utf-8')
+            if arg not in clang_args:
+                clang_args.append(arg)
+
+    options = 0
+    if fast:
+        options = getattr(TranslationUnit, 'PARSE_SKIP_FUNCTION_BODIES', 0x40) | \
+                  getattr(TranslationUnit, 'PARSE_INCOMPLETE', 0x02)
+
+    if len(basenames) == 1:
+        tu_name = join(C_FILES, basenames[0] + C_EXT)
+        return TranslationUnit.from_source(tu_name, args=clang_args, options=options)
+
+    tu_name = join(C_FILES, SHARED_BASENAME + C_EXT)
+    content = ''.join('#include "' + bn + C_EXT + '"\n' for bn in basenames)
+    return TranslationUnit.from_source(tu_name, args=clang_args, unsaved_files=[(tu_name, content)],
+                                       options=options)
+
+
+def collect_nodes(top_level_nodes, constants):
     functions = {}
     types = OrderedDict()
     # order is important, otherwise the builders will refer to non-existing types.
 
-    clang_args = [arg.encode('utf-8') for arg in constants.PKG_CONFIG_RES]
-    include_paths = [arg[2:] for arg in constants.PKG_CONFIG_RES if arg[:2] == '-I']
-    tu_name = join(C_FILES, basename + C_EXT)
-
-    tu = TranslationUnit.from_source(tu_name, args=clang_args)
-    for node in tu.cursor.get_children():
-        name = name_of(node)
-        if any(regex.match(name) for regex in constants.BLACKLISTED):
-            continue
+    whitelisted_files = {}
+    # ^ the whitelist check is cached per file, and done before anything else
+    #   since most top-level nodes come from system headers.
 
+    for node in top_level_nodes:
         source_file = node.location.file
         if source_file:
-            source_filename = source_file.name.decode('utf-8')
-            if not any(source_filename.startswith(whitelist) for whitelist in constants.HEADER_WHITELIST):
+            source_filename = source_file.name
+            is_whitelisted = whitelisted_files.get(source_filename)
+            if is_whitelisted is None:
+                decoded_filename = source_filename.decode('utf-8')
+                is_whitelisted = any(decoded_filename.startswith(whitelist)
+                                     for whitelist in constants.HEADER_WHITELIST)
+                whitelisted_files[source_filename] = is_whitelisted
+            if not is_whitelisted:
                 continue
 
         kind = node.kind
+        if kind not in {CursorKind.FUNCTION_DECL, CursorKind.STRUCT_DECL, CursorKind.ENUM_DECL}:
+            continue
+
+        name = name_of(node)
+        if any(regex.match(name) for regex in constants.BLACKLISTED):
+            continue
+
         if kind == CursorKind.FUNCTION_DECL:
             functions[name] = node
-        elif kind in {CursorKind.STRUCT_DECL, CursorKind.ENUM_DECL}:
+        else:
             types[name] = node
 
-    return (types.values(), functions.values())
+    return (types, functions)
+
+
+def extract_nodes(collected):
+    """
+    Convert the collected nodes to the IR, so that the translation unit can be
+    released before the code is written.
+    """
+    from ir import Extractor
+
+    extractor = Extractor()
+    return [(OrderedDict((name, extractor.cursor(node)) for name, node in types.items()),
+             {name: extractor.cursor(node) for name, node in functions.items()})
+            for (types, functions) in collected]
 
 
 def get_mod_name(cursor):
     filename = cursor.location.file.name.decode('utf-8')
     return camelize(splitext(basename(filename))[0])
 
+#-------------------------------------------------------------------------------
 
-def translate(basename):
-    constants = import_module(basename)
-
-    (types, functions) = collect_nodes(basename, constants)
-    grouped_functions = group_by(functions, get_mod_name)
-
-    makedirs(join(SRC, basename + OUT_EXT), exist_ok=True)
+def write_types(basename, constants, types, extra_datatypes,
+                headers=None, shared_basename=None, with_epilog=True, split_builders=False):
+    """
+    Write the builders and datatypes of the types.
+    """
+    from builders import BuildersWriter
+    from datatype import DataTypeDeclWriter, DataTypeWriter
 
-    with BuildersWriter(basename, constants) as bf, \
-            DataTypeDeclWriter(basename, constants) as dtd, \
-            DataTypeWriter(basename, constants) as dt:
+    with BuildersWriter(basename, constants, shared_basename, with_epilog, split_builders) as bf, \
+            DataTypeDeclWriter(basename, constants, headers, shared_basename) as dtd, \
+            DataTypeWriter(basename, constants, shared_basename) as dt:
         for type_decl in types:
             bf.write_type(type_decl)
             if type_decl.kind == CursorKind.STRUCT_DECL:
@@ -74,19 +133,310 @@ def translate(basename):
                     dtd.write_datatype(struct_name)
                     dt.write_datatype(struct_name)
 
-    with ModuleHeaderWriter(basename) as mh, ModuleWriter(basename) as m:
-        for modname, functions in grouped_functions.items():
+        for struct_name, definition in extra_datatypes.items():
+            bf.write_datatype(struct_name)
+            dtd.write(definition)
+            dtd.write_datatype(struct_name)
+            dt.write_datatype(struct_name)
+
+
+def write_modules(basename, constants, functions, use_cache=True, generic=False, lazy=False,
+                  probes=False, trace=False):
+    """
+    Write the builtins of the functions. The rendered functions are cached in
+    the output directory by their fingerprints, so only the functions whose
+    signature or rules changed are rendered again. With *generic*, the
+    functions with a simple shape are bound through the generic wrapper. With
+    *lazy*, the builtins are created on first lookup (see `ModuleHeaderWriter`).
+    With *probes*, every builtin is probed, and each module gets a ``stats``
+    builtin returning (and resetting) the counters. With *trace*, the builtins
+    of simple functions record their calls, and the replay tool is written.
+
+    The Oz benchmark functor of the builtins is written too (see
+    `BenchmarkWriter`).
+    """
+    from module import ModuleHeaderWriter, ModuleWriter
+    from replay import ReplayWriter
+    from bench import BenchmarkWriter
+    from ozfunc import OzFunction, ExtraFunction, AsyncOzFunction
+    from cache import FunctionCache, fingerprint, render, signature_of
+
+    grouped_functions = group_by(functions, get_mod_name)
+    modnames = list(grouped_functions.keys())
+    modnames.extend(m for m in constants.EXTRA_FUNCTIONS if m not in grouped_functions)
+
+    cache = FunctionCache(join(SRC, basename + OUT_EXT, FUNCTION_CACHE_NAME), load=use_cache)
+
+    traced = []
+
+    with ModuleHeaderWriter(basename, lazy) as mh, ModuleWriter(basename, constants, lazy, probes, trace) as m, \
+            BenchmarkWriter(basename, constants, lazy) as bw:
+        for modname in modnames:
+            functions = grouped_functions.get(modname, [])
             ozfunc_names = list(strip_common_prefix_and_camelize(map(name_of, functions)))
+
+            # the functions are all created before any is rendered, so the
+            # generated names are the same as without the cache.
+            ozfuncs = []
+            for function, ozfunc_name in zip(functions, ozfunc_names):
+                sync_mode = 'generic' if generic else 'sync'
+                if trace:
+                    sync_mode += '+trace'
+                modes = [(sync_mode, ozfunc_name)]
+                if any(regex.match(name_of(function)) for regex in constants.OFFLOADABLE):
+                    modes.append(('async', ozfunc_name + 'Async'))
+
+                sync_ozfunc = None
+                for mode, name in modes:
+                    key = fingerprint(function, name, mode, constants)
+                    rendered = cache.get(key)
+                    if rendered is None:
+                        if sync_ozfunc is None:
+                            sync_ozfunc = OzFunction(function, ozfunc_name, constants, generic, trace)
+                        if mode != 'async':
+                            ozfunc = sync_ozfunc
+                        else:
+                            ozfunc = AsyncOzFunction(sync_ozfunc, constants)
+                        rendered = (key, ozfunc, function)
+                    ozfuncs.append(rendered)
+
+            for i, ozfunc in enumerate(ozfuncs):
+                if isinstance(ozfunc, tuple):
+                    (key, ozfunc, function) = ozfunc
+                    ozfuncs[i] = render(ozfunc, name_of(function), signature_of(function))
+                    cache.put(key, ozfuncs[i])
+                if ozfuncs[i].traced:
+                    traced.append(ozfuncs[i].source_function_name)
+
+            for ozfunc_name, (arg_proto, func_def) in constants.EXTRA_FUNCTIONS.get(modname, {}).items():
+                ozfuncs.append(ExtraFunction(ozfunc_name, arg_proto, func_def))
+
+            stats = None
+            if probes:
+                stats = ExtraFunction('stats', ', Out result', """
+                    result = ProbeCounters::collect(vm, "{0}");
+                """.format(modname))
+                ozfuncs.append(stats)
+
             with mh.write_module(modname):
-                for function, ozfunc_name in zip(functions, ozfunc_names):
-                    ozfunc = OzFunction(function, ozfunc_name, constants)
+                for ozfunc in ozfuncs:
                     mh.write_function(ozfunc)
-                    m.write_function(modname, ozfunc)
+                    m.write_function(modname, ozfunc, probe=ozfunc is not stats)
+            if lazy:
+                m.write_lookup(modname, [ozfunc.oz_function_name for ozfunc in ozfuncs])
+            bw.write_module(modname, ozfuncs)
 
+    if trace:
+        with ReplayWriter(basename) as rw:
+            for c_func_name in traced:
+                rw.write_function(c_func_name)
 
-if __name__ == '__main__':
-    if len(sys.argv) <= 1:
-        print("Usage: ./translator.py [module-name]")
-    else:
-        translate(sys.argv[1])
+    cache.save()
+    return cache
+
+
+def translate(basenames, fast_parse=False, use_cache=True, split_builders=False,
+              generic=False, lazy=False, probes=False, trace=False, verbose=False):
+    """
+    Generate the bindings of the modules. When several modules are given, their
+    C files are parsed once, the types used by more than one module are written
+    to the shared headers (following the rules of the first module listed), and
+    every function is only generated for the first module which collects it.
+
+    With *fast_parse*, the C files are parsed in the fast mode of `parse`. If
+    *use_cache* is false, all functions are rendered again. With
+    *split_builders*, the builders are defined in ``-builders.cc`` files
+    instead of the builders headers. With *generic*, simple functions are bound
+    through the generic wrapper template. With *lazy*, the modules only export
+    a lookup function, which creates the builtins on demand. With *probes*, the
+    builtins count their calls, time and allocations when compiled with
+    ``M2G3_ENABLE_PROBES``. With *trace*, the builtins of simple functions
+    record their calls when ``M2G3_TRACE`` is set, and a ``-replay.cc`` tool
+    is written to run the trace again.
+
+    The umbrella header ``src/<first module>-pch.hh`` of the headers which do
+    not change between translations is written for the precompiled header
+    build. A depfile ``src/<first module>.d`` is written, making the outputs
+    depend on the files read by the parse and the Python files used (see
+    `write_depfile`). With *verbose*, the startup time (the imports of the
+    translator and of the constants modules, whose `pkg_config` results are
+    cached), the parse time, the number of cursors kept and the functions
+    reused from the cache are reported.
+    """
+    start_time = perf_counter()
+    constants_list = [import_module(bn) for bn in basenames]
+    constants_time = perf_counter() - start_time
+    if verbose:
+        print('started in {0:.1f}ms (imports {1:.1f}ms, constants {2:.1f}ms)'.format(
+            (perf_counter() - _load_time) * 1000, _import_time * 1000, constants_time * 1000),
+            file=sys.stderr)
+
+    start_time = perf_counter()
+    tu = parse(basenames, constants_list, fast_parse)
+    parse_time = perf_counter() - start_time
+    top_level_nodes = list(tu.cursor.get_children())
+    collected = [collect_nodes(top_level_nodes, constants) for constants in constants_list]
+    if verbose:
+        kept = len({name for (types, functions) in collected for name in chain(types, functions)})
+        print('parsed in {0:.3f}s, kept {1} of {2} top-level cursors'.format(
+            parse_time, kept, len(top_level_nodes)), file=sys.stderr)
+    collected = extract_nodes(collected)
+    source_files = included_files(tu, basenames)
+    del tu, top_level_nodes
+
+    for bn in basenames:
+        makedirs(join(SRC, bn + OUT_EXT), exist_ok=True)
+
+    if len(basenames) == 1:
+        (types, functions) = collected[0]
+        write_types(basenames[0], constants_list[0], types.values(), constants_list[0].EXTRA_DATATYPES,
+                    split_builders=split_builders)
+        cache = write_modules(basenames[0], constants_list[0], functions.values(), use_cache, generic, lazy, probes, trace)
+        if verbose:
+            _report_cache(basenames[0], cache)
+        write_precompiled_header(basenames, constants_list, lazy, probes, trace)
+        write_depfile(join(SRC, basenames[0] + DEPFILE_EXT),
+                      output_files(basenames[0], split_builders, trace),
+                      source_files + generator_files(constants_list))
+        return
+
+    type_counts = Counter(name for (types, _) in collected for name in types)
+    shared_types = OrderedDict()
+    for (types, _) in collected:
+        for name, node in types.items():
+            if type_counts[name] > 1:
+                shared_types.setdefault(name, node)
+
+    write_types(SHARED_BASENAME, constants_list[0], shared_types.values(), {},
+                headers=basenames, with_epilog=False, split_builders=split_builders)
+
+    seen_functions = set()
+    for bn, constants, (types, functions) in zip(basenames, constants_list, collected):
+        own_types = [node for name, node in types.items() if name not in shared_types]
+        own_functions = [node for name, node in functions.items() if name not in seen_functions]
+        seen_functions.update(functions)
+
+        write_types(bn, constants, own_types, constants.EXTRA_DATATYPES,
+                    shared_basename=SHARED_BASENAME, split_builders=split_builders)
+        cache = write_modules(bn, constants, own_functions, use_cache, generic, lazy, probes, trace)
+        if verbose:
+            _report_cache(bn, cache)
+
+    write_precompiled_header(basenames, constants_list, lazy, probes, trace)
 
+    outputs = output_files(SHARED_BASENAME, split_builders, shared=True)
+    for bn in basenames:
+        outputs.extend(output_files(bn, split_builders, trace))
+    write_depfile(join(SRC, basenames[0] + DEPFILE_EXT), outputs,
+                  source_files + generator_files(constants_list))
+
+
+def write_precompiled_header(basenames, constants_list, lazy=False, probes=False, trace=False):
+    """
+    Write the umbrella header of the modules (see `PrecompiledHeaderWriter`),
+    with the headers included by the builders and the modules. It is not one
+    of the `output_files`, since it is only replaced when it changes.
+    """
+    from builders import BUILDERS_INCLUDES
+    from module import module_includes
+    from pch import PrecompiledHeaderWriter
+
+    includes = list(BUILDERS_INCLUDES)
+    for constants in constants_list:
+        includes.extend(module_includes(constants, lazy, probes, trace))
+    with PrecompiledHeaderWriter(basenames[0], basenames, includes):
+        pass
+
+
+def included_files(tu, basenames):
+    """
+    List the files read to parse the translation unit, i.e. the C files of the
+    modules and every header they include.
+    """
+    files = OrderedDict((join(C_FILES, bn + C_EXT), None) for bn in basenames)
+    for inclusion in tu.get_includes():
+        files.setdefault(inclusion.include.name.decode('utf-8'))
+    return list(files)
+
+
+def generator_files(constants_list):
+    """
+    List the Python files the generator used, i.e. the constants modules and
+    the modules loaded from the directory of the generator.
+    """
+    generator_dir = dirname(abspath(__file__))
+    files = OrderedDict((abspath(constants.__file__), None) for constants in constants_list)
+    for module in list(sys.modules.values()):
+        filename = getattr(module, '__file__', None)
+        if filename and filename.endswith('.py'):
+            filename = abspath(filename)
+            if filename.startswith(generator_dir + sep):
+                files.setdefault(filename)
+    return list(files)
+
+
+def output_files(basename, split_builders=False, trace=False, shared=False):
+    """
+    List the files written for a module (or for the shared types if *shared*
+    is true).
+    """
+    exts = [TYPES_DECL_HH_EXT, TYPES_HH_EXT, BUILDERS_HH_EXT]
+    if split_builders:
+        exts.append(BUILDERS_CC_EXT)
+    if not shared:
+        exts.extend([CC_EXT, HH_EXT, BENCH_OZ_EXT])
+        if trace:
+            exts.append(REPLAY_CC_EXT)
+    return [join(SRC, basename + ext) for ext in exts]
+
+
+def write_depfile(filename, targets, dependencies):
+    """
+    Write a make-compatible depfile, making the *targets* depend on the
+    *dependencies*. Like ``gcc -MP``, every dependency also gets an empty rule,
+    so that the build does not fail when a file is removed.
+    """
+    def escape(path):
+        if isabs(path) and abspath(path).startswith(getcwd() + sep):
+            path = relpath(path)
+        return path.replace('$', '$$').replace(' ', '\\ ')
+
+    dependencies = list(map(escape, dependencies))
+    with open(filename, 'w') as f:
+        f.write(' '.join(map(escape, targets)) + ':')
+        for dependency in dependencies:
+            f.write(' \\\n    ' + dependency)
+        f.write('\n\n')
+        for dependency in dependencies:
+            f.write(dependency + ':\n')
+
+
+def _report_cache(basename, cache):
+    print('{0}: reused {1} functions, rendered {2}'.format(basename, cache.hits, cache.misses),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Generate Mozart/Oz bindings of C libraries.')
+    parser.add_argument('modules', metavar='module-name', nargs='+',
+                        help='name of the constants module, e.g. cairo')
+    parser.add_argument('--fast-parse', action='store_true',
+                        help='skip function bodies and accept incomplete translation units')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help='render all functions again, ignoring the cached ones')
+    parser.add_argument('--split-builders', action='store_true',
+                        help='define the builders in a -builders.cc file instead of the header')
+    parser.add_argument('--generic', action='store_true',
+                        help='bind simple functions through a generic wrapper template')
+    parser.add_argument('--lazy', action='store_true',
+                        help='create the builtins on first lookup through Module.lookup (experimental)')
+    parser.add_argument('--probes', action='store_true',
+                        help='add call, time and allocation counters, and a stats builtin per module')
+    parser.add_argument('--trace', action='store_true',
+                        help='record the calls of simple builtins, and write a tool replaying them')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='report the parse time, cursors kept and functions reused')
+    args = parser.parse_args()
+    translate(args.modules, fast_parse=args.fast_parse, use_cache=args.use_cache,
+              split_builders=args.split_builders, generic=args.generic,
+              lazy=args.lazy, probes=args.probes, trace=args.trace, verbose=args.verbose)
@@ -1,4 +1,5 @@
 import re
+from os import replace, remove
 from abc import ABCMeta, abstractmethod
 from ccformat import CCFormatter
 
@@ -7,17 +8,42 @@ non_alphabets_re = re.compile('[^a-zA-Z0-9_]')
 class Writer(metaclass=ABCMeta):
     """
     A generic C++ file writer.
+
+    The formatted code is streamed to a temporary file, which replaces the
+    target file when the writer exits successfully. If *streaming* is false, the
+    code is kept in memory and written on exit instead.
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, streaming=True):
         self._filename = filename
+        self._streaming = streaming
+        self._file = None
         self._writer = CCFormatter()
 
     def __enter__(self):
+        if self._streaming:
+            self._file = open(self._filename + '.tmp', 'w')
+            self._writer = CCFormatter(self._file)
         self.write_prolog()
         return self
 
     def __exit__(self, p, q, r):
+        if self._file is not None:
+            (f, self._file) = (self._file, None)
+            try:
+                if p is None:
+                    self.write_epilog()
+            except:
+                p = True
+                raise
+            finally:
+                f.close()
+                if p is None:
+                    replace(f.name, self._filename)
+                else:
+                    remove(f.name)
+            return False
+
         self.write_epilog()
         with open(self._filename, 'w') as f:
             f.writelines(self._writer.lines)